@@ -1,7 +1,7 @@
 # Import necessary modules
-import os, requests, urllib3, json, sys
+import os, requests, urllib3, json, sys, time, math
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
-from pympler import asizeof
 import pandas as pd
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 ##################################################################
@@ -37,8 +37,44 @@ appStatus = list(statusMapDict.keys())
 
 end_time = datetime.now().astimezone().isoformat()
 
+# connectTimeout => Seconds to wait for a connection to the Unravel server
+# readTimeout    => Seconds to wait for the Unravel server to send each response
+connectTimeout = 10
+readTimeout = 300
+
+# One pooled HTTP session shared by every request, created in main()
+httpSession = None
+
+# benchmarkMode     => If True, benchmark both endpoints across every page size and concurrency level below.
+#                      If False, time a single request to each endpoint, as before
+# benchmarkRecords  => Number of records fetched in each trial (capped at the available record count)
+# warmupTrials      => Trials run, and discarded, before measuring each configuration
+# measuredTrials    => Trials measured for each configuration
+# pageSizes         => Page sizes ('size' per request) to compare
+# concurrencyLevels => Number of pages fetched at once to compare
+benchmarkMode = True
+benchmarkRecords = 5000
+warmupTrials = 1
+measuredTrials = 5
+pageSizes = [100, 500, 1000, 5000]
+concurrencyLevels = [1, 4, 8]
+benchmarkEndpoints = ['inefficient_apps', 'unified_search']
+
 ##################################################################
 # Start Functions Block
+##################################################################
+def create_http_session(pool_size: int):
+    # Keep-alive connection pool sized so that no worker waits for a connection,
+    # asking the server for compressed response bodies
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    return session
+##################################################################
+
+
 ##################################################################
 def print_api_debug_info(f_status, f_data, f_message: str, f_result: str):
     f_message = "{}{} Failed to acquire {}.  Status code: {}".format(
@@ -83,10 +119,11 @@ def get_auth_token(platform):
     endpoint_url = '{}/api/v1/signIn'.format(urlsDict[platform])
 
     # POST to the auth endpoint with the auth data
-    response = requests.post(
+    response = httpSession.post(
         endpoint_url,
         data=authDict,
-        verify=True
+        verify=True,
+        timeout=(connectTimeout, readTimeout)
     )
 
     # Check the response status code
@@ -122,10 +159,11 @@ def record_count(url, auth_token):
                    }
 
     # Request the number of available records
-    response = requests.post(
+    response = httpSession.post(
         search_url,
         data=json.dumps(params_dict),
         verify=False,
+        timeout=(connectTimeout, readTimeout),
         headers={'Authorization': auth_token,
                  'Accept': 'application/json',
                  'Content-Type': 'application/json'})
@@ -206,10 +244,11 @@ def unified_search(url, auth_token, count: int):
     print("{}Retrieving data for {} queries:".format(spacer, params_dict['size']))
 
     # Query UnifiedSearch API to get reference data on all queries
-    response = requests.post(
+    response = httpSession.post(
         search_url,
         data=json.dumps(params_dict),
         verify=False,
+        timeout=(connectTimeout, readTimeout),
         headers={'Authorization': auth_token,
                  'Accept': 'application/json',
                  'Content-Type': 'application/json'})
@@ -236,9 +275,10 @@ def inefficient_apps(url, auth_token, count: int):
                    'entityType': str(entityList)}
 
     apps_url = url + '/api/v1/apps/events/inefficient_apps_newux/'
-    search_response = requests.get(
+    search_response = httpSession.get(
         apps_url,
         verify=False,
+        timeout=(connectTimeout, readTimeout),
         params=params_dict,
         headers=headers_dict).json()
 #     print("Old method returned a data type of: {}".format(type(search_response)))
@@ -252,8 +292,154 @@ def inefficient_apps(url, auth_token, count: int):
 ##################################################################
 
 
+##################################################################
+def fetch_page(endpoint: str, url, auth_token, start_time, page_from: int, page_size: int):
+    # Fetch a single page from one endpoint, returning the raw timing sample for the request. A request that fails
+    # outright (timeout, refused connection) is returned as an error sample so the rest of the sweep still runs.
+    headers_dict = {'Authorization': auth_token,
+                    'Accept': 'application/json'}
+    started = time.perf_counter()
+    try:
+        if endpoint == 'unified_search':
+            headers_dict['Content-Type'] = 'application/json'
+            response = httpSession.post(
+                url + '/api/v1/apps/unifiedsearch',
+                data=json.dumps({'from': page_from,
+                                 'size': page_size,
+                                 'start_time': start_time,
+                                 'end_time': end_time,
+                                 'executed_by_unravel': False,
+                                 'appStatus': appStatus,
+                                 'appTypes': appTypes}),
+                verify=False,
+                timeout=(connectTimeout, readTimeout),
+                headers=headers_dict)
+        else:
+            response = httpSession.get(
+                url + '/api/v1/apps/events/inefficient_apps_newux/',
+                params={'start_time': start_time,
+                        'from': page_from,
+                        'size': page_size,
+                        'end_time': end_time,
+                        'entityType': str(entityList)},
+                verify=False,
+                timeout=(connectTimeout, readTimeout),
+                headers=headers_dict)
+        body = response.json() if response.status_code == 200 else None
+    except (ValueError, requests.exceptions.RequestException):
+        return {
+            'page_from': page_from,
+            'latency_s': time.perf_counter() - started,
+            'bytes': 0,
+            'records': 0,
+            'status': None,
+            'error': True
+        }
+    latency = time.perf_counter() - started
+
+    return {
+        'page_from': page_from,
+        'latency_s': latency,
+        'bytes': response.raw.tell() or len(response.content),
+        'records': len(body['results']) if isinstance(body, dict) and 'results' in body else 0,
+        'status': response.status_code,
+        'error': not isinstance(body, dict) or 'results' not in body
+    }
+##################################################################
+
+
+##################################################################
+def run_trial(endpoint: str, url, auth_token, count: int, page_size: int, concurrency: int):
+    # Fetch count records in pages of page_size, with up to concurrency pages in flight. Every page of a trial
+    # shares one start_time so the pages slice the same window.
+    start_time = subtract_days_from_now(lookbackDays)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(
+            lambda page_from: fetch_page(
+                endpoint, url, auth_token, start_time, page_from, min(page_size, count - page_from)
+            ),
+            range(0, count, page_size)
+        ))
+    return time.perf_counter() - started, samples
+##################################################################
+
+
+##################################################################
+def percentile(values: list, pct: float):
+    # Nearest-rank percentile
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)] if values else None
+##################################################################
+
+
+##################################################################
+def benchmark(url, auth_token, recordCount: int):
+    import pandas as pd
+
+    count = min(benchmarkRecords, recordCount)
+    summary_rows = []
+    sample_rows = []
+    for endpoint in benchmarkEndpoints:
+        for page_size in pageSizes:
+            for concurrency in concurrencyLevels:
+                print("{}{}: {} records, page size {}, concurrency {}".format(
+                    spacer, endpoint, count, page_size, concurrency)
+                )
+                for trial in range(warmupTrials):
+                    run_trial(endpoint, url, auth_token, count, page_size, concurrency)
+
+                throughputs = []
+                latencies = []
+                trial_bytes = []
+                errors = 0
+                for trial in range(measuredTrials):
+                    elapsed, samples = run_trial(endpoint, url, auth_token, count, page_size, concurrency)
+                    records = sum(sample['records'] for sample in samples)
+                    throughputs.append(records / elapsed)
+                    latencies.extend(sample['latency_s'] for sample in samples)
+                    trial_bytes.append(sum(sample['bytes'] for sample in samples))
+                    errors += sum(sample['error'] for sample in samples)
+                    for sample in samples:
+                        sample_rows.append(dict(
+                            endpoint=endpoint, page_size=page_size, concurrency=concurrency, trial=trial, **sample
+                        ))
+
+                throughputs.sort()
+                summary_rows.append({
+                    'endpoint': endpoint,
+                    'page_size': page_size,
+                    'concurrency': concurrency,
+                    'records/s (median)': round(percentile(throughputs, 50), 1),
+                    'records/s (min)': round(throughputs[0], 1),
+                    'records/s (max)': round(throughputs[-1], 1),
+                    'latency p50 (ms)': round(percentile(latencies, 50) * 1000, 1),
+                    'latency p95 (ms)': round(percentile(latencies, 95) * 1000, 1),
+                    'latency p99 (ms)': round(percentile(latencies, 99) * 1000, 1),
+                    'kB per trial': round(sum(trial_bytes) / len(trial_bytes) / 1024),
+                    'errors': errors
+                })
+
+    summary_df = pd.DataFrame(summary_rows).sort_values('records/s (median)', ascending=False)
+    print("\n{}".format(summary_df.to_string(index=False)))
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S.%f')[:-7]
+    summary_file = dataDir + '/API_Benchmark-Summary-{}.csv'.format(timestamp)
+    samples_file = dataDir + '/API_Benchmark-Samples-{}.csv'.format(timestamp)
+    summary_df.to_csv(summary_file, index=False)
+    pd.DataFrame(sample_rows).to_csv(samples_file, index=False)
+    print("\n{}Benchmark comparison output to:\n\t\t {}".format(spacer, summary_file))
+    print("{}Raw request samples output to:\n\t\t {}".format(spacer, samples_file))
+##################################################################
+
+
 ##################################################################
 def main():
+    global httpSession
+
+    # Share one pooled, compressed HTTP session between every request
+    httpSession = create_http_session(max(concurrencyLevels))
+
     # Get auth_token
     print("Stage 1: Generating authentication token")
     auth_token = get_auth_token(platform)
@@ -268,6 +454,11 @@ def main():
 #     # Construct the UnifiedSearch API URL
 #     search_url = base_url + '/api/v1/apps/events/inefficient_apps_newux/'
 
+    if benchmarkMode:
+        print("Stage 3: Benchmarking endpoints")
+        benchmark(base_url, auth_token, recordCount)
+        return
+
     # Test against Inefficient Apps API
     run_starttime = datetime.now()
     print("Start  (1):", str(datetime.now().time())[:-7])
@@ -279,7 +470,6 @@ def main():
     print("Start  (2):", str(datetime.now().time())[:-7])
     query_data = unified_search(base_url, auth_token, recordCount)
     print("Total execution time (unified_search): {}".format(datetime.now() - run_starttime))
-    exit(1)
 
 ##################################################################
 # End Functions Block
@@ -10,6 +10,7 @@
 ##################################################################
 
 # Output report contains these fields, unique per query:
+# "Target"              ==> The Unravel instance of the query. Only when reporting on several targets
 # "clusterId"           ==> The identifier of the parent cluster
 # "id"                  ==> Pipeline/query identifier
 # "Unravel UI link"     ==> Direct link to Unravel UI
@@ -25,25 +26,31 @@
 ##################################################################
 
 # Import necessary modules
-import os, requests, urllib3, json, sys
+import os, requests, urllib3, json, sys, sqlite3, threading, time, csv, heapq, tracemalloc, math, codecs, gzip, io
+import random, argparse, base64, glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import redirect_stdout
 from datetime import timedelta, datetime
-from ydata_profiling import ProfileReport
-from pympler import asizeof
-import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak RSS is simply not reported
+    resource = None
+try:
+    # orjson decodes API responses several times faster than the standard library, if installed
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 # Debug mode flag. If active, there is a LOT more verbosity
 # Set to either True or False.
 debug = False
 
-# Disable warnings from urllib3 about unverified HTTPS requests
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-# Prevent interpreter complaining about wobbly file handles
-pd.options.mode.chained_assignment = None
-
-# Record the start time of the script
-run_start_time = datetime.now()
-print("Start  :", str(datetime.now().time())[:-7])
+# Heavy modules (pandas) are imported by the stage that first needs them, and nothing runs at import
+# time, so the script starts quickly and can be imported without side effects
 ##################################################################
 
 # Define the required configurations for the script
@@ -75,17 +82,228 @@ platform = 'bigquery'
 # appTypes = ['spark', 'impala', 'hive', 'mr', 'tez', 'bigquery']
 appTypes = ['bigquery']
 
+# targets => Report on several Unravel instances and platforms in one run. Each target is a dict of:
+#            'name'         ==> Label for the instance, added as the "Target" column of the combined report
+#            'platform'     ==> One of the platforms above, which selects the API endpoints to use
+#            'url'          ==> Unravel instance URL
+#            'appTypes'     ==> Optional. Defaults to all activity types of the platform
+#            'username_env' ==> Optional. Environment variable holding this instance's Unravel username
+#            'password_env' ==> Optional. Environment variable holding this instance's Unravel password
+#            Each target is collected in its own worker process, with its own auth token, analysis cache and
+#            run state, then merged into one combined report and Top N. Leave empty to report on the single
+#            urlsDict[platform] instance, as before
+# targets = [
+#     {'name': 'gcp-bq', 'platform': 'bigquery', 'url': 'https://unravel-bq.yourdomain.com:3000'},
+#     {'name': 'aws-emr', 'platform': 'emr', 'url': 'https://unravel-emr.yourdomain.com:3000',
+#      'username_env': 'unravel_emr_username', 'password_env': 'unravel_emr_password'}
+# ]
+# targetWorkers => Number of targets collected at once
+targets = []
+targetWorkers = 4
+
+# fetchWorkers => Number of per-query analysis requests to run concurrently in Stage 5
+# Set to 1 to revert to fetching one query at a time
+fetchWorkers = 16
+
+# minFetchWorkers  => Stage 5 adapts the number of analysis requests in flight between minFetchWorkers and
+#                     fetchWorkers. It is halved when the server answers 429/5xx or doesn't answer at all, or when
+#                     latency rises above latencyTolerance times its best level, and grows by one again for each
+#                     round of healthy responses
+# latencyTolerance => Set to None to only react to errors
+# analysisRetries  => Attempts at a query's analysis on a transient error (429, 5xx or no response) before the
+#                     query is skipped. Skipped queries are listed, with the reason, in a Skipped report
+# retryBaseDelay   => Seconds to wait before the first retry, doubling with each attempt up to retryMaxDelay.
+#                     The wait is randomised (full jitter), and is never shorter than a Retry-After from the server
+minFetchWorkers = 1
+latencyTolerance = 3.0
+analysisRetries = 4
+retryBaseDelay = 0.5
+retryMaxDelay = 30
+
+# searchPageSize => Number of queries requested per page from the UnifiedSearch API in Stage 3
+# searchWorkers  => Number of UnifiedSearch pages to fetch concurrently
+# pageRetries    => Number of attempts for a single failed page before giving up
+searchPageSize = 1000
+searchWorkers = 4
+pageRetries = 5
+
+# searchShardDays => Split the lookback window into shards of this many days. Each shard is counted and fetched
+#                    on its own, and in parallel with the others, so that no single search has to cover the
+#                    whole window. Queries found in more than one shard are only reported once.
+#                    Set to None to search the whole window at once
+searchShardDays = 1
+
+# cacheFile       => SQLite file caching the analysis of finished queries between runs. Set to None to disable
+# cacheTTLDays    => Cached analysis older than this many days is fetched again
+# cacheMaxEntries => Once exceeded, the oldest cached analysis is evicted
+cacheFile = os.path.join(dataDir, 'Analysis_Cache.sqlite')
+cacheTTLDays = 30
+cacheMaxEntries = 250000
+
+# prefilterMode => Use the queries the server has already flagged as inefficient (the inefficient_apps endpoint)
+#                  to decide which queries are worth a per-query analysis request in Stage 5. Choices:
+# 1. None       ==> Fetch the analysis of every query
+# 2. 'filter'   ==> Only fetch the analysis of flagged queries. The others are left out of the report
+# 3. 'verify'   ==> Fetch the analysis of every query, as with None, and report how many analysis requests the
+#                   filter would have saved, and which report rows it would have missed
+prefilterMode = None
+
+# incrementalMode => If True, only fetch queries that are new since the last successful run, or that had not
+#                    finished at the time, and merge them into that run's results. Without saved state from a
+#                    previous run, a full lookback run is done instead
+# stateFile       => File holding the high-water mark and per-query results of the last successful run.
+#                    Set to None to disable
+# recheckDays     => Unfinished queries are searched for again by each incremental run, to pick up their current
+#                    status and cost. This searches, in full, every day on which such a query started, so only those
+#                    that started within the last recheckDays days are searched. Older ones are taken as they were
+#                    at the last run, as statuses such as Unknown or Waiting may never finish. An incremental run
+#                    therefore costs up to recheckDays days' worth of searches, on top of the new queries
+incrementalMode = False
+stateFile = os.path.join(dataDir, 'Impact_Report_State.json')
+recheckDays = 2
+
+# checkpointFile => Append-only journal of the current run: the Stage 4 work list, then the result of every query
+#                   as it is processed. After a crash or Ctrl-C, run the script with --resume to carry on from the
+#                   last processed query, producing the same report as an uninterrupted run. The journal is removed
+#                   once a run completes. Set to None to disable
+checkpointFile = os.path.join(dataDir, 'Impact_Report_Checkpoint.jsonl')
+
+# topCount    => Number of queries in each Top N report
+# topRankings => The Top N reports to generate. Choices:
+# 1. 'Impact Value'     ==> Sum of all query Impact score values (the original Top 10 report)
+# 2. 'Cost (USD)'       ==> Query cost, in USD
+# 3. 'High Impact'      ==> "High Impact" count
+# 4. 'Impact x Cost'    ==> Impact Value multiplied by Cost (USD)
+topCount = 10
+topRankings = ['Impact Value', 'Cost (USD)', 'High Impact', 'Impact x Cost']
+
+# rollupTables => Summary tables written alongside the full report, aggregated over every report row as it is
+#                 scored, so that totals never need the full report to be reloaded. Each table has one row per
+#                 group, with its query count, total Impact Value, Cost (USD) and Impact x Cost, and its
+#                 High/Medium/Low Impact counts. Choices:
+# 1. 'Insight'  ==> Per insight name, over every "insightsV2" entry of each query, using the insight's own
+#                   impact. Its High/Medium/Low counts band that impact, where the report's band the running
+#                   total of each entry, so they need not add up to those of the report
+# 2. 'Cluster'  ==> Per clusterId
+# 3. 'Status'   ==> Per query status
+rollupTables = ['Insight', 'Cluster', 'Status']
+
+# reportCompression => Compress the full report CSV as it is written. Choices:
+# 1. None               ==> Plain CSV
+# 2. 'gzip'             ==> .csv.gz
+# 3. 'zstd'             ==> .csv.zst, smaller and faster than gzip. Requires the zstandard package
+# parquetOutput     => If True, also write the full report as a Parquet dataset under parquetDir, with "Insights"
+#                      as a list of strings rather than stringified text. Files are partitioned by clusterId and
+#                      run date (clusterId=.../run_date=.../). Requires the pyarrow package
+reportCompression = None
+parquetOutput = False
+parquetDir = os.path.join(dataDir, 'Impact_Report-Parquet')
+
+# memoryTracing => If True, also trace Python allocations (tracemalloc) to report the peak Python memory of
+#                  each stage. Tracing slows Stage 5 down around three times, so only use it when investigating
+#                  memory use. Process RSS and peak RSS are always sampled at the end of each stage
+memoryTracing = False
+
+# metricsOutput => If True, write per-stage and per-request timing metrics next to the report files,
+#                  as both JSON and a Prometheus textfile
+metricsOutput = True
+
+# connectTimeout => Seconds to wait for a connection to the Unravel server
+# readTimeout    => Seconds to wait for the Unravel server to send each response
+connectTimeout = 10
+readTimeout = 300
+
 # You can use Unravel UI credentials to generate auth_tokens at runtime.
 # Example format for storing Unravel credentials in your *nix/macOS profile:
 # export unravel_username=username
 # export unravel_password=password
+# usernameEnv/passwordEnv => The environment variables holding these credentials. Targets can set their own
+usernameEnv = 'unravel_username'
+passwordEnv = 'unravel_password'
+
+# tokenCacheFile     => File caching the authentication token between runs, readable by the owner only, so that
+#                       a run can skip signing in while its token is still valid. Set to None to always sign in
+# tokenRefreshMargin => Don't reuse a cached token that expires within this many seconds
+# A token that expires during a run is refreshed when the server rejects it, once for all workers
+tokenCacheFile = os.path.join(dataDir, 'Impact_Report_Token.json')
+tokenRefreshMargin = 300
+
+# serveHost/servePort => With --serve, the script keeps running, and serves the latest report from this local
+#                        HTTP endpoint. The report, its Top N, skipped queries and run metrics are held in memory,
+#                        and only replaced once the next run has completed, so readers never see a partial report.
+#                        GET / for the status and the list of files served
+# refreshMinutes      => With --serve, start a new run this many minutes after the start of the last one.
+#                        The HTTP session and authentication token are kept between runs
+# serveKeepRuns       => With --serve, keep the report files of this many completed runs in dataDir, removing
+#                        those of older runs, and of failed runs, so that disk use doesn't grow with every refresh
+serveHost = '127.0.0.1'
+servePort = 8089
+refreshMinutes = 60
+serveKeepRuns = 1
 
 # End of customer-defined config items
 ##################################################################
 breakString = '################################################################################'
 spacer = '         '
 entityList = [1, 0, 2, 6, 16, 15, 11]
-baseLabels = ['id', 'clusterId', 'cents', 'status']
+baseLabels = ['id', 'clusterId', 'cents', 'status', 'started']
+searchFields = ['id', 'clusterId', 'cents', 'status', 'startTime']
+reportColumns = ['clusterId', 'id', 'Unravel UI link', 'Cost (USD)', 'Status', 'Impact Value',
+                 'High Impact', 'Medium Impact', 'Low Impact', 'Instance Count', 'Insights']
+
+# API endpoint adapter for each supported platform: the per-query analysis path, the Unravel UI link,
+# and the activity types searched for when a target doesn't set its own
+# Only the BigQuery endpoints have been verified. The others follow the Unravel UI's Spark application pages
+platformAdapters = {
+    'bigquery': {
+        'analysis': '/api/v1/bigquery/{cluster_id}/{query_id}/analysis',
+        'ui_link': '/#/app/application/apptype/bigquery?execId={query_id}&projectId={cluster_id}',
+        'appTypes': ['bigquery']
+    },
+    'dataproc': {
+        'analysis': '/api/v1/spark/{cluster_id}/{query_id}/analysis',
+        'ui_link': '/#/app/application/spark?execId={query_id}&clusterUid={cluster_id}',
+        'appTypes': ['spark', 'hive', 'mr', 'tez']
+    },
+    'emr': {
+        'analysis': '/api/v1/spark/{cluster_id}/{query_id}/analysis',
+        'ui_link': '/#/app/application/spark?execId={query_id}&clusterUid={cluster_id}',
+        'appTypes': ['spark', 'hive', 'mr', 'tez', 'impala']
+    },
+    'databricks': {
+        'analysis': '/api/v1/spark/{cluster_id}/{query_id}/analysis',
+        'ui_link': '/#/app/application/spark?execId={query_id}&clusterUid={cluster_id}',
+        'appTypes': ['spark']
+    }
+}
+
+# Number of queries whose analysis is scored together in one vectorised pass
+scoreBatchSize = 500
+
+# File name suffix of the full report for each reportCompression choice
+compressionSuffixes = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# Number of report rows per cluster held before they are written out as a Parquet row group
+parquetBatchSize = 10000
+
+# The ranking value of a report row for each supported Top N report, and its output file name label
+rankingKeys = {
+    'Impact Value': lambda row: row['Impact Value'],
+    'Cost (USD)': lambda row: row['Cost (USD)'],
+    'High Impact': lambda row: row['High Impact'],
+    'Impact x Cost': lambda row: row['Impact Value'] * row['Cost (USD)']
+}
+rankingFileLabels = {
+    'Impact Value': '',
+    'Cost (USD)': 'By-Cost-',
+    'High Impact': 'By-High-Impact-',
+    'Impact x Cost': 'By-Impact-x-Cost-'
+}
+
+# The group column of each rollup table, and the totals kept for every group
+rollupGroupColumns = {'Insight': 'Insight', 'Cluster': 'clusterId', 'Status': 'Status'}
+rollupColumns = ['Queries', 'Impact Value', 'Cost (USD)', 'Impact x Cost', 'High Impact', 'Medium Impact',
+                 'Low Impact']
 
 # Set FQDN of our API endpoint
 base_url = urlsDict[platform]
@@ -103,7 +321,40 @@ statusMapDict = {
 }
 appStatus = list(statusMapDict.keys())
 
-end_time = datetime.now().astimezone().isoformat()
+# Analysis for queries in these states never changes, so it is safe to cache
+terminalStatus = ['S', 'F', 'K']
+cacheLock = threading.Lock()
+cacheStats = {'hits': 0, 'stores': 0}
+
+# What the inefficient_apps pre-filter saved, or in verify mode would have saved and missed, in Stage 5
+prefilterStats = {}
+
+# Adaptive concurrency of analysis requests, see minFetchWorkers. Reset at the start of Stage 5
+fetchLimiter = {}
+fetchLimiterCondition = threading.Condition()
+
+# The authentication token in use, shared by all workers, and what is needed to sign in again for a new one
+authState = {}
+authLock = threading.Lock()
+
+# HTTP status codes worth retrying, as the server is only temporarily unable to answer
+transientStatus = [429, 500, 502, 503, 504]
+
+# The lookback window of the run, set at the start of main()
+end_time = None
+start_time = None
+
+# One pooled HTTP session shared by every stage, created on first use
+httpSession = None
+httpSessionLock = threading.Lock()
+
+# Timing and memory samples for each stage, and timing of each API request, reported at the end of the run
+stageMetrics = []
+requestMetrics = {}
+metricsLock = threading.Lock()
+
+# The report files and metrics of the last completed run, as served by --serve. Replaced as a whole by each run
+servedReport = {}
 ##################################################################
 
 
@@ -123,16 +374,224 @@ def subtract_days_from_now(days):
 
 
 ##################################################################
-def get_impact_label(value: int):
-    rating = ''
-    if value > 70:
-        rating = 'High'
-    elif (value > 30) and (value < 71):
-        rating = 'Medium'
-    else:
-        rating = 'Low'
+def rss_kb():
+    # Current and peak resident set size of this process, in kB. None where the platform can't tell us
+    current_kb = None
+    if os.path.isfile('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            current_kb = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+    peak_kb = None
+    if resource is not None:
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports ru_maxrss in bytes, Linux in kB
+        if sys.platform == 'darwin':
+            peak_kb = peak_kb // 1024
+
+    return current_kb, peak_kb
+##################################################################
+
+
+##################################################################
+def begin_stage(stage_label: str):
+    # Print the stage banner, closing off the memory sample of the stage before it
+    end_stage()
+    print(stage_label)
+    if memoryTracing and tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    stageMetrics.append({'stage': stage_label.split(':')[0], 'started': time.perf_counter()})
+##################################################################
+
+
+##################################################################
+def end_stage():
+    if not stageMetrics or 'rss_kb' in stageMetrics[-1]:
+        return
+
+    stageMetrics[-1]['seconds'] = round(time.perf_counter() - stageMetrics[-1].pop('started'), 3)
+    stageMetrics[-1]['rss_kb'], stageMetrics[-1]['rss_peak_kb'] = rss_kb()
+    if memoryTracing and tracemalloc.is_tracing():
+        stageMetrics[-1]['traced_peak_kb'] = round(tracemalloc.get_traced_memory()[1] / 1024)
+##################################################################
+
+
+##################################################################
+def print_stage_metrics():
+    end_stage()
+    print("{}Time (s) and memory usage (kB) per stage:".format(spacer))
+    print("{}\t{:<10}{:>10}{:>14}{:>14}{:>16}".format(spacer, 'Stage', 'Time', 'RSS', 'Peak RSS', 'Peak traced'))
+    for metrics in stageMetrics:
+        print("{}\t{:<10}{:>10}{:>14}{:>14}{:>16}".format(
+            spacer, metrics['stage'], metrics['seconds'], str(metrics['rss_kb']), str(metrics['rss_peak_kb']),
+            str(metrics.get('traced_peak_kb', '-')))
+        )
+
+    print("{}API request latency (ms):".format(spacer))
+    print("{}\t{:<14}{:>10}{:>8}{:>10}{:>10}{:>10}{:>14}".format(
+        spacer, 'Endpoint', 'Requests', 'Errors', 'p50', 'p95', 'p99', 'kB received')
+    )
+    for endpoint, summary in summarise_requests().items():
+        print("{}\t{:<14}{:>10}{:>8}{:>10}{:>10}{:>10}{:>14}".format(
+            spacer, endpoint, summary['requests'], summary['errors'], summary['p50_ms'], summary['p95_ms'],
+            summary['p99_ms'], round(summary['bytes'] / 1024))
+        )
+##################################################################
+
+
+##################################################################
+def create_http_session(pool_size: int):
+    # Keep-alive connection pool sized so that no worker waits for a connection,
+    # asking the server for compressed response bodies
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    return session
+##################################################################
+
+
+##################################################################
+def get_http_session():
+    global httpSession
+    with httpSessionLock:
+        if httpSession is None:
+            httpSession = create_http_session(max(fetchWorkers, searchWorkers))
+    return httpSession
+##################################################################
+
+
+##################################################################
+def response_json(response):
+    # Decode a response body straight from its raw bytes, exactly once
+    # Returns None if the body isn't valid JSON
+    try:
+        return json_loads(response.content)
+    except ValueError:
+        return None
+##################################################################
+
+
+##################################################################
+def timed_request(endpoint: str, method: str, url, **kwargs):
+    # Make an API request on the shared session, recording its latency, bytes received over the wire
+    # (before decompression) and outcome against the endpoint name
+    kwargs.setdefault('timeout', (connectTimeout, readTimeout))
+    started = time.perf_counter()
+    try:
+        response = get_http_session().request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+        record_request(endpoint, time.perf_counter() - started, 0, True)
+        raise
+
+    # A streamed body hasn't been read yet, so only the time to the response headers is recorded here
+    size = 0 if kwargs.get('stream') else response.raw.tell() or len(response.content)
+    record_request(endpoint, time.perf_counter() - started, size, response.status_code != 200)
+    return response
+##################################################################
+
+
+##################################################################
+def record_request(endpoint: str, seconds: float, size: int, error: bool):
+    with metricsLock:
+        metrics = requestMetrics.setdefault(endpoint, {'latencies': [], 'bytes': 0, 'errors': 0})
+        metrics['latencies'].append(seconds)
+        metrics['bytes'] += size
+        metrics['errors'] += int(error)
+##################################################################
 
-    return rating
+
+##################################################################
+def record_bytes(endpoint: str, size: int):
+    # Add the bytes of a streamed response, which are only known once the stream has been read
+    with metricsLock:
+        requestMetrics.setdefault(endpoint, {'latencies': [], 'bytes': 0, 'errors': 0})['bytes'] += size
+##################################################################
+
+
+##################################################################
+def percentile(sorted_values: list, pct: float):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)]
+##################################################################
+
+
+##################################################################
+def summarise_requests():
+    summaries = {}
+    with metricsLock:
+        for endpoint, metrics in requestMetrics.items():
+            latencies = sorted(metrics['latencies'])
+            summaries[endpoint] = {
+                'requests': len(latencies),
+                'errors': metrics['errors'],
+                'bytes': metrics['bytes'],
+                'seconds_total': round(sum(latencies), 3)
+            }
+            for pct in (50, 95, 99):
+                summaries[endpoint]['p{}_ms'.format(pct)] = round(percentile(latencies, pct) * 1000, 1)
+
+    return summaries
+##################################################################
+
+
+##################################################################
+def format_run_metrics():
+    # The stage and request metrics as JSON, and in the Prometheus text format
+    request_summaries = summarise_requests()
+    run_metrics = {'end_time': end_time, 'stages': stageMetrics, 'requests': request_summaries}
+    if prefilterMode and prefilterStats:
+        run_metrics['prefilter'] = dict(prefilterStats, mode=prefilterMode)
+    metrics_json = json.dumps(run_metrics, indent=2)
+
+    lines = ['# TYPE impact_report_stage_seconds gauge']
+    for metrics in stageMetrics:
+        lines.append('impact_report_stage_seconds{{stage="{}"}} {}'.format(metrics['stage'], metrics['seconds']))
+    lines.append('# TYPE impact_report_stage_rss_peak_kilobytes gauge')
+    for metrics in stageMetrics:
+        if metrics['rss_peak_kb'] is not None:
+            lines.append('impact_report_stage_rss_peak_kilobytes{{stage="{}"}} {}'.format(
+                metrics['stage'], metrics['rss_peak_kb'])
+            )
+    lines.append('# TYPE impact_report_request_seconds summary')
+    for endpoint, summary in request_summaries.items():
+        for pct in (50, 95, 99):
+            lines.append('impact_report_request_seconds{{endpoint="{}",quantile="{}"}} {}'.format(
+                endpoint, pct / 100, summary['p{}_ms'.format(pct)] / 1000)
+            )
+        lines.append('impact_report_request_seconds_sum{{endpoint="{}"}} {}'.format(
+            endpoint, summary['seconds_total'])
+        )
+        lines.append('impact_report_request_seconds_count{{endpoint="{}"}} {}'.format(endpoint, summary['requests']))
+    lines.append('# TYPE impact_report_request_errors_total counter')
+    for endpoint, summary in request_summaries.items():
+        lines.append('impact_report_request_errors_total{{endpoint="{}"}} {}'.format(endpoint, summary['errors']))
+    lines.append('# TYPE impact_report_response_bytes_total counter')
+    for endpoint, summary in request_summaries.items():
+        lines.append('impact_report_response_bytes_total{{endpoint="{}"}} {}'.format(endpoint, summary['bytes']))
+    if prefilterMode and prefilterStats:
+        lines.append('# TYPE impact_report_prefilter_queries gauge')
+        for name in ('flagged', 'unflagged', 'missed_rows'):
+            lines.append('impact_report_prefilter_queries{{mode="{}",count="{}"}} {}'.format(
+                prefilterMode, name, prefilterStats[name])
+            )
+
+    return metrics_json, '\n'.join(lines) + '\n'
+##################################################################
+
+
+##################################################################
+def write_run_metrics(metrics_file_base: str, metrics: tuple):
+    # Write the formatted run metrics as JSON, and as a Prometheus textfile collector file
+    metrics_file_base = os.path.expanduser(metrics_file_base)
+    metrics_json, metrics_prom = metrics
+
+    with open(metrics_file_base + '.json', 'w') as f:
+        f.write(metrics_json)
+    with open(metrics_file_base + '.prom', 'w') as f:
+        f.write(metrics_prom)
 ##################################################################
 
 
@@ -145,27 +604,30 @@ def print_api_debug_info(f_status, f_data, f_message: str, f_result: str):
     print("{}BEGIN DEBUG OUTPUT".format(spacer))
     print("{}\tURL:\t\t\t{}".format(spacer, f_data.request.url))
     print("{}\tHEADERS:\t\t{}".format(spacer, f_data.request.headers))
-    if f_data.request.body.__contains__('username' or 'password='):
+    # GET requests carry no body at all
+    body = f_data.request.body or ''
+    if 'username' in str(body) or 'password=' in str(body):
         print("{}\tBODY:\t\t\t**REDACTED FOR SECURITY**".format(spacer))
     else:
-        print("{}\tBODY:\t\t\t{}".format(spacer, f_data.request.body))
-    print("{}\tRESPONSE DATA:\t{}".format(spacer, f_data.json()))
+        print("{}\tBODY:\t\t\t{}".format(spacer, body))
+    print("{}\tRESPONSE DATA:\t{}".format(spacer, response_json(f_data)))
     print("{}{}...".format(spacer, f_result))
 
 ##################################################################
 
 
 ##################################################################
-def get_auth_token(platform):
+def sign_in(platform, username_env='unravel_username', password_env='unravel_password'):
     # Create a dictionary with the username and password stored in $USER_ENV
     authDict = {
-        'username': os.getenv('unravel_username', None),
-        'password': os.getenv('unravel_password', None)
+        'username': os.getenv(username_env, None),
+        'password': os.getenv(password_env, None)
     }
     endpoint_url = '{}/api/v1/signIn'.format(urlsDict[platform])
 
     # POST to the auth endpoint with the auth data
-    response = requests.post(
+    response = timed_request(
+        'signIn', 'POST',
         endpoint_url,
         data=authDict,
         verify=True
@@ -177,8 +639,9 @@ def get_auth_token(platform):
         exit(1)
 
     # Parse the authentication token from the response body
-    if response.json()['token']:
-        auth_token = 'JWT {}'.format(response.json()['token'])
+    body = response_json(response)
+    if isinstance(body, dict) and body.get('token'):
+        auth_token = 'JWT {}'.format(body['token'])
         print("{}Successfully generated authentication token.".format(spacer))
     else:
         print_api_debug_info('CRITICAL FAILURE!', response, 'authentication token', 'Exiting....')
@@ -190,27 +653,191 @@ def get_auth_token(platform):
 
 
 ##################################################################
-def record_count(url, auth_token):
+def token_expiry(auth_token: str):
+    # The 'exp' claim of a JWT, in seconds since the epoch, or None if the token doesn't say
+    try:
+        payload = auth_token.split(' ', 1)[-1].split('.')[1]
+        expiry = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp']
+        return expiry if isinstance(expiry, (int, float)) else None
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+##################################################################
+
+
+##################################################################
+def token_cache_key(platform, username_env: str):
+    # Cached tokens are kept per Unravel instance and user
+    return '{} {}'.format(urlsDict[platform], os.getenv(username_env, ''))
+##################################################################
+
+
+##################################################################
+def token_still_valid(auth_token):
+    # True if auth_token is valid for at least tokenRefreshMargin
+    expiry = token_expiry(auth_token) if auth_token else None
+    return expiry is not None and expiry - time.time() >= tokenRefreshMargin
+##################################################################
+
+
+##################################################################
+def load_cached_token(platform, username_env: str):
+    # A cached token for this instance and user that is valid for at least tokenRefreshMargin, or None
+    # A token already held from an earlier run of this process (see --serve) is used before the cache file
+    with authLock:
+        if (authState.get('platform'), authState.get('url'), authState.get('username_env')) == (
+                platform, urlsDict[platform], username_env) and token_still_valid(authState['token']):
+            return authState['token']
+
+    if not tokenCacheFile or not os.path.isfile(os.path.expanduser(tokenCacheFile)):
+        return None
+    try:
+        with open(os.path.expanduser(tokenCacheFile)) as f:
+            auth_token = json.load(f).get(token_cache_key(platform, username_env))
+    except (OSError, ValueError, AttributeError):
+        return None
+
+    return auth_token if token_still_valid(auth_token) else None
+##################################################################
+
+
+##################################################################
+def save_cached_token(platform, username_env: str, auth_token: str):
+    # Keep the token for the next run, in a file only its owner can read
+    if not tokenCacheFile:
+        return
+    cache_file = os.path.expanduser(tokenCacheFile)
+    try:
+        with open(cache_file) as f:
+            tokens = json.load(f)
+        if not isinstance(tokens, dict):
+            tokens = {}
+    except (OSError, ValueError):
+        tokens = {}
+    tokens[token_cache_key(platform, username_env)] = auth_token
+
+    try:
+        os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+        fd = os.open(cache_file + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(tokens, f)
+        os.replace(cache_file + '.tmp', cache_file)
+    except OSError:
+        print("{}Failure when caching the authentication token to: {}".format(spacer, tokenCacheFile))
+##################################################################
+
+
+##################################################################
+def get_auth_token(platform, username_env='unravel_username', password_env='unravel_password'):
+    # Reuse the cached token while it is valid, otherwise sign in for a new one
+    # The token becomes the one shared by all requests of this run, see authorised_request()
+    auth_token = load_cached_token(platform, username_env)
+    if auth_token:
+        print("{}Reusing cached authentication token, valid until {}".format(
+            spacer, datetime.fromtimestamp(token_expiry(auth_token)).isoformat(timespec='seconds'))
+        )
+    else:
+        auth_token = sign_in(platform, username_env, password_env)
+        save_cached_token(platform, username_env, auth_token)
+
+    with authLock:
+        authState.clear()
+        authState.update({'token': auth_token, 'platform': platform, 'url': urlsDict[platform],
+                          'username_env': username_env, 'password_env': password_env, 'refreshes': 0})
+    return auth_token
+##################################################################
+
+
+##################################################################
+def refresh_auth_token(rejected_token: str):
+    # Sign in again after the server rejected rejected_token. Workers that were rejected at the same time
+    # wait on the one doing the refresh, then all use its new token, so only one sign in is made
+    with authLock:
+        if authState['token'] == rejected_token:
+            print("{}Authentication token was rejected, so signing in again".format(spacer))
+            authState['token'] = sign_in(authState['platform'], authState['username_env'], authState['password_env'])
+            authState['refreshes'] += 1
+            save_cached_token(authState['platform'], authState['username_env'], authState['token'])
+        return authState['token']
+##################################################################
+
+
+##################################################################
+def authorised_request(endpoint: str, method: str, url, headers: dict, **kwargs):
+    # timed_request() with the current shared auth token. If the server rejects the token as expired,
+    # it is refreshed and the request is made once more
+    auth_token = authState.get('token') or headers.get('Authorization')
+    response = timed_request(endpoint, method, url, headers=dict(headers, Authorization=auth_token), **kwargs)
+    if response.status_code == 401 and authState:
+        response.close()
+        auth_token = refresh_auth_token(auth_token)
+        response = timed_request(endpoint, method, url, headers=dict(headers, Authorization=auth_token), **kwargs)
+    return response
+##################################################################
+
+
+##################################################################
+def search_windows():
+    # Split the [start_time, end_time] search window into shards of searchShardDays, newest first
+    window_start = start_time or subtract_days_from_now(lookbackDays)
+    if not searchShardDays:
+        return [(window_start, end_time)]
+
+    # Naive times are local, the same as end_time
+    first = datetime.fromisoformat(window_start).astimezone()
+    shard_end = datetime.fromisoformat(end_time).astimezone()
+    windows = []
+    while True:
+        shard_start = shard_end - timedelta(days=searchShardDays)
+        if shard_start <= first:
+            windows.append((window_start, shard_end.isoformat() if windows else end_time))
+            return windows
+        windows.append((shard_start.isoformat(), shard_end.isoformat() if windows else end_time))
+        shard_end = shard_start
+##################################################################
+
+
+##################################################################
+def no_queries_found():
+    # Clearly something went wrong, as the returned value was zero
+    print("\n{}".format(breakString))
+    print("{}Well, this is awkward......".format(spacer))
+    print("{}In our attempt to get our first stage data (high level data of all your queries)".format(spacer))
+    print("{}\t\twe got ZERO results. Exiting.......".format(spacer))
+    print("{}\n".format(breakString))
+    # Exit
+    exit(1)
+##################################################################
+
+
+##################################################################
+def record_count(url, auth_token, allow_empty=False, window=None, quiet=False):
+    # Count the queries in window, a (start_time, end_time) pair, which defaults to the whole search window
     # Construct the UnifiedSearch API URL
     search_url = url + '/api/v1/apps/unifiedsearch'
+    window_start, window_end = window or (start_time or subtract_days_from_now(lookbackDays), end_time)
 
     params_dict = {'from': 0,
                    'size': 1,
-                   'start_time': subtract_days_from_now(lookbackDays),
-                   'end_time': end_time,
+                   'start_time': window_start,
+                   'end_time': window_end,
                    'executed_by_unravel': False,
                    'appStatus': appStatus,
                    'appTypes': appTypes
                    }
 
-    # Request the number of available records
-    response = requests.post(
-        search_url,
-        data=json.dumps(params_dict),
-        verify=False,
-        headers={'Authorization': auth_token,
-                 'Accept': 'application/json',
-                 'Content-Type': 'application/json'})
+    # Request the number of available records, retrying while the server is only temporarily unavailable
+    for attempt in range(1, max(1, pageRetries) + 1):
+        response = authorised_request(
+            'unifiedsearch', 'POST',
+            search_url,
+            data=json.dumps(params_dict),
+            verify=False,
+            headers={'Authorization': auth_token,
+                     'Accept': 'application/json',
+                     'Content-Type': 'application/json'})
+        if response.status_code not in transientStatus or attempt == max(1, pageRetries):
+            break
+        time.sleep(retry_delay(attempt, response))
 
     # Check the response status code
     if response.status_code != 200:
@@ -218,40 +845,36 @@ def record_count(url, auth_token):
         exit(1)
 
     # Navigate down looking for presence of 'totalRecords' k:v pair
-    if not isinstance(response.json(), dict):
+    body = response_json(response)
+    if not isinstance(body, dict):
         print_api_debug_info('CRITICAL FAILURE!', response, 'record count', 'Exiting....')
         exit(1)
 
-    if 'metadata' not in response.json().keys():
+    if 'metadata' not in body.keys():
         print_api_debug_info('CRITICAL FAILURE!', response, 'record count', 'Exiting....')
         exit(1)
 
-    if 'totalRecords' not in response.json()['metadata'].keys():
+    if 'totalRecords' not in body['metadata'].keys():
         print_api_debug_info('CRITICAL FAILURE!', response, 'record count', 'Exiting....')
         exit(1)
 
-    if not isinstance(response.json()['metadata']['totalRecords'], int):
+    if not isinstance(body['metadata']['totalRecords'], int):
         print_api_debug_info('CRITICAL FAILURE!', response, 'record count', 'Exiting....')
         exit(1)
 
     # Now we can capture the response value for 'totalRecords'
-    responseCount = response.json()['metadata']['totalRecords']
-
-    if responseCount == 0:
-        # Clearly something went wrong, as the returned value was zero
-        print("\n{}".format(breakString))
-        print("{}Well, this is awkward......".format(spacer))
-        print("{}In our attempt to get our first stage data (high level data of all your queries)".format(spacer))
-        print("{}\t\twe got ZERO results. Exiting.......".format(spacer))
-        print("{}\n".format(breakString))
-        # Exit
-        exit(1)
+    responseCount = body['metadata']['totalRecords']
+
+    if responseCount == 0 and not allow_empty:
+        no_queries_found()
+
+    if quiet:
+        return responseCount
 
     # Check for a 'clusters' block to capture a cluster count
-    if 'clusters' in response.json()['metadata'].keys():
-        if isinstance(response.json()['metadata']['clusters'], dict
-        ) and isinstance(len(response.json()['metadata']['clusters'].keys()), int):
-            cCount = len(response.json()['metadata']['clusters'].keys())
+    if 'clusters' in body['metadata'].keys():
+        if isinstance(body['metadata']['clusters'], dict):
+            cCount = len(body['metadata']['clusters'].keys())
             print("{}Total query count: {}, from {} clusters".format(spacer, responseCount, cCount))
     # No 'clusters' block detected, so skipping
     else:
@@ -261,55 +884,1066 @@ def record_count(url, auth_token):
 
 
 ##################################################################
-def unified_search(url, auth_token, count: int):
-    # Construct the UnifiedSearch API URL
-    search_url = url + '/api/v1/apps/unifiedsearch'
+def shard_counts(url, auth_token, allow_empty=False):
+    # Count the queries of every search window shard, up to searchWorkers shards at once
+    # Returns a list of ((start_time, end_time), count) pairs, newest first
+    windows = search_windows()
+    if len(windows) == 1:
+        return [(windows[0], record_count(url, auth_token, allow_empty, windows[0]))]
+
+    counts = list(bounded_map(
+        lambda window: record_count(url, auth_token, True, window, quiet=True), windows, searchWorkers
+    ))
+    if sum(counts) == 0 and not allow_empty:
+        no_queries_found()
+
+    print("{}Total query count: {}, in {} shards of {} days".format(
+        spacer, sum(counts), len(windows), searchShardDays)
+    )
+    return list(zip(windows, counts))
+##################################################################
 
-    # set the count parameter to 250, for testing
-    # count = 250
 
-    # set the count parameter to 90%, for testing
-    # count = round(count * 0.90)
+##################################################################
+def open_analysis_cache(cache_file):
+    # Open (or create) the on-disk analysis cache, then evict expired and surplus entries
+    if not cache_file:
+        return None
+
+    cache_file = os.path.expanduser(cache_file)
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    cache_conn = sqlite3.connect(cache_file, check_same_thread=False)
+    cache_conn.execute('PRAGMA journal_mode=WAL')
+    cache_conn.execute(
+        'CREATE TABLE IF NOT EXISTS analysis ('
+        'cluster_id TEXT NOT NULL, query_id TEXT NOT NULL, fetched_at REAL NOT NULL, body TEXT NOT NULL, '
+        'PRIMARY KEY (cluster_id, query_id))'
+    )
+    cache_conn.execute('CREATE INDEX IF NOT EXISTS analysis_fetched_at ON analysis (fetched_at)')
+    prune_analysis_cache(cache_conn)
 
-    params_dict = {'from': 0,
-                   'size': count,
-                   'start_time': subtract_days_from_now(lookbackDays),
-                   'end_time': end_time,
+    return cache_conn
+##################################################################
+
+
+##################################################################
+def prune_analysis_cache(cache_conn):
+    # Evict entries older than cacheTTLDays, then the oldest entries beyond cacheMaxEntries
+    with cacheLock:
+        cache_conn.execute('DELETE FROM analysis WHERE fetched_at < ?', (time.time() - cacheTTLDays * 86400,))
+        cache_conn.execute(
+            'DELETE FROM analysis WHERE rowid IN ('
+            'SELECT rowid FROM analysis ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)',
+            (cacheMaxEntries,)
+        )
+        cache_conn.commit()
+        entry_count = cache_conn.execute('SELECT COUNT(*) FROM analysis').fetchone()[0]
+
+    if debug:
+        print("{}Analysis cache holds {} entries".format(spacer, entry_count))
+##################################################################
+
+
+##################################################################
+def get_cached_analysis(cache_conn, cluster_id, query_id):
+    # Return the cached analysis body for a query, or None if missing or expired
+    with cacheLock:
+        row = cache_conn.execute(
+            'SELECT body FROM analysis WHERE cluster_id = ? AND query_id = ? AND fetched_at >= ?',
+            (str(cluster_id), str(query_id), time.time() - cacheTTLDays * 86400)
+        ).fetchone()
+        if row:
+            cacheStats['hits'] += 1
+
+    return row[0] if row else None
+##################################################################
+
+
+##################################################################
+def put_cached_analysis(cache_conn, cluster_id, query_id, body: bytes):
+    with cacheLock:
+        cache_conn.execute(
+            'INSERT OR REPLACE INTO analysis (cluster_id, query_id, fetched_at, body) VALUES (?, ?, ?, ?)',
+            (str(cluster_id), str(query_id), time.time(), body)
+        )
+        cache_conn.commit()
+        cacheStats['stores'] += 1
+##################################################################
+
+
+##################################################################
+def query_key(cluster_id, query_id):
+    return '{}/{}'.format(cluster_id, query_id)
+##################################################################
+
+
+##################################################################
+def load_report_state(state_file):
+    # Load the high-water mark and per-query results saved by the last successful run, if any
+    # The state file holds a header line with the run end_time, then one JSON line per query
+    if not state_file or not os.path.isfile(os.path.expanduser(state_file)):
+        return None
+
+    queries = {}
+    with open(os.path.expanduser(state_file)) as f:
+        header = json_loads(f.readline())
+        for line in f:
+            entry = json_loads(line)
+            # State saved before query start times were kept has no start time, and is aged out by 'seen'
+            entry['query'] = entry['query'] + [0] * (len(baseLabels) - len(entry['query']))
+            queries[entry.pop('key')] = entry
+
+    return {'end_time': header['end_time'], 'queries': queries}
+##################################################################
+
+
+##################################################################
+def open_report_file(out_file):
+    # Open the full report CSV for writing as text, compressed as set by reportCompression
+    if reportCompression == 'gzip':
+        return gzip.open(out_file, 'wt', newline='')
+    if reportCompression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            print("{}reportCompression 'zstd' requires the zstandard package. Exiting....".format(spacer))
+            exit(1)
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(out_file, 'wb')), newline='')
+    return open(out_file, 'w', newline='', buffering=1)
+##################################################################
+
+
+##################################################################
+def open_parquet_output(parquet_dir, file_name):
+    # Set up the Parquet dataset output. A writer is opened per cluster partition the first time that cluster
+    # has a full batch of rows, or when the report is closed
+    try:
+        import pyarrow as pa
+    except ImportError:
+        print("{}parquetOutput requires the pyarrow package. Exiting....".format(spacer))
+        exit(1)
+
+    # clusterId is not stored in the files, as it is the partition key
+    schema = pa.schema([
+        ('id', pa.string()),
+        ('Unravel UI link', pa.string()),
+        ('Cost (USD)', pa.float64()),
+        ('Status', pa.string()),
+        ('Impact Value', pa.int64()),
+        ('High Impact', pa.int64()),
+        ('Medium Impact', pa.int64()),
+        ('Low Impact', pa.int64()),
+        ('Instance Count', pa.int64()),
+        ('Insights', pa.list_(pa.string()))
+    ])
+    return {
+        'dir': os.path.expanduser(parquet_dir),
+        'run_date': datetime.fromisoformat(end_time).strftime('%Y-%m-%d'),
+        'file_name': file_name,
+        'schema': schema,
+        'pending': {},
+        'writers': {}
+    }
+##################################################################
+
+
+##################################################################
+def write_parquet_rows(parquet, cluster_id):
+    # Write the pending rows of one cluster as a row group of that cluster's partition file
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rows = parquet['pending'].pop(cluster_id, [])
+    if not rows:
+        return
+    if cluster_id not in parquet['writers']:
+        partition_dir = os.path.join(parquet['dir'], 'clusterId={}'.format(quote(str(cluster_id), safe='')),
+                                     'run_date={}'.format(parquet['run_date']))
+        os.makedirs(partition_dir, exist_ok=True)
+        parquet['writers'][cluster_id] = pq.ParquetWriter(os.path.join(partition_dir, parquet['file_name']),
+                                                          parquet['schema'], compression='zstd')
+    parquet['writers'][cluster_id].write_table(pa.Table.from_pylist(rows, schema=parquet['schema']))
+##################################################################
+
+
+##################################################################
+def close_parquet_output(parquet):
+    # Write out what is still pending for every cluster, then close all of the partition files
+    for cluster_id in list(parquet['pending']):
+        write_parquet_rows(parquet, cluster_id)
+    for writer in parquet['writers'].values():
+        writer.close()
+##################################################################
+
+
+##################################################################
+def open_report(out_file, state_file, previous_state):
+    # Open the full report CSV, and the next run state file, for rows to be written to as they are scored.
+    # Only the Top N rows are held in memory, so a crash still leaves every row written so far on disk
+    report = {
+        'out_file': os.path.expanduser(out_file),
+        'state_file': os.path.expanduser(state_file) if state_file else None,
+        'previous': previous_state['queries'] if previous_state else {},
+        'seen': datetime.now().isoformat(),
+        'top': {ranking: [] for ranking in topRankings},
+        'rollups': {table: {} for table in rollupTables},
+        'rows': 0,
+        'queries': 0,
+        'skipped': []
+    }
+    os.makedirs(os.path.dirname(report['out_file']) or '.', exist_ok=True)
+    report['file'] = open_report_file(report['out_file'])
+    report['writer'] = csv.DictWriter(report['file'], fieldnames=reportColumns, lineterminator='\n')
+    report['writer'].writeheader()
+    # Parquet files are named after the report, so that a resumed run replaces those of the run it resumes
+    report['parquet'] = None
+    if parquetOutput:
+        report['parquet'] = open_parquet_output(
+            parquetDir, 'part-{}.parquet'.format(os.path.basename(report['out_file']).split('.')[0])
+        )
+    report['journal'] = None
+
+    # The new run state is only moved into place once the run completes
+    report['state'] = None
+    if report['state_file']:
+        report['state'] = open(report['state_file'] + '.tmp', 'w')
+        report['state'].write(json.dumps({'end_time': end_time}) + '\n')
+
+    return report
+##################################################################
+
+
+##################################################################
+def record_query(report, query, row, seen=None, filtered=False, insights=None):
+    # Record every processed query, including discarded ones, in the run state for the next incremental run
+    # Queries left out by the pre-filter are marked as such, so that they are fetched once the filter is turned off
+    # insights are the [name, impact] pairs of the insights listed in the row, as returned by score_entities()
+    report['queries'] += 1
+    if report['state']:
+        key = query_key(query[0], query[1])
+        if seen is None:
+            seen = report['previous'][key]['seen'] if key in report['previous'] else report['seen']
+        entry = {'key': key, 'seen': seen, 'query': list(query), 'row': row}
+        if filtered:
+            entry['filtered'] = True
+        if row and insights:
+            entry['insights'] = insights
+        report['state'].write(json.dumps(entry, default=lambda o: o.item() if hasattr(o, 'item') else str(o)) + '\n')
+
+    if not row:
+        return
+
+    report['writer'].writerow(row)
+    report['rows'] += 1
+
+    if report['parquet']:
+        pending = report['parquet']['pending'].setdefault(row['clusterId'], [])
+        pending.append(row)
+        if len(pending) >= parquetBatchSize:
+            write_parquet_rows(report['parquet'], row['clusterId'])
+
+    update_rollups(report['rollups'], row, insights)
+
+    # One bounded min-heap of the Top N rows per ranking, all filled in this single pass.
+    # The row number breaks ties, so equal values keep the order in which they were scored
+    for ranking, top_heap in report['top'].items():
+        entry = (rankingKeys[ranking](row), -report['rows'], row)
+        if len(top_heap) < topCount:
+            heapq.heappush(top_heap, entry)
+        elif entry[:2] > top_heap[0][:2]:
+            heapq.heapreplace(top_heap, entry)
+##################################################################
+
+
+##################################################################
+def rollup_groups(table: str, row, insights):
+    # The (group, Impact Value, High, Medium, Low) contributions of a report row to a rollup table
+    if table != 'Insight':
+        group = row['clusterId'] if table == 'Cluster' else row['Status']
+        return [(group, row['Impact Value'], row['High Impact'], row['Medium Impact'], row['Low Impact'])]
+
+    # Each insight contributes its own impact, and is banded on it. The High/Medium/Low counts of a report row
+    # band each insight on the running total of its "insightsV2" entry instead, so the two need not agree
+    # A query with the same insight in several entries is one query of that insight, with the sum of them
+    groups = {}
+    for name, impact in insights or []:
+        high, medium = impact_bands(impact)
+        totals = groups.setdefault(name, [0, 0, 0, 0])
+        totals[0] += impact
+        totals[1] += int(high)
+        totals[2] += int(medium)
+        totals[3] += int(not (high or medium))
+    return [(name, impact, high, medium, low) for name, (impact, high, medium, low) in groups.items()]
+##################################################################
+
+
+##################################################################
+def update_rollups(rollups: dict, row, insights):
+    # Add a report row, and the [name, impact] pairs of its listed insights, to the running totals of each rollup
+    for table, totals in rollups.items():
+        for group, impact, high, medium, low in rollup_groups(table, row, insights):
+            group_totals = totals.get(group)
+            if group_totals is None:
+                group_totals = totals[group] = [0, 0, 0.0, 0.0, 0, 0, 0]
+            group_totals[0] += 1
+            group_totals[1] += impact
+            group_totals[2] += row['Cost (USD)']
+            group_totals[3] += impact * row['Cost (USD)']
+            group_totals[4] += high
+            group_totals[5] += medium
+            group_totals[6] += low
+##################################################################
+
+
+##################################################################
+def rollup_rows(table: str, totals: dict):
+    # The rows of a rollup table, highest total Impact Value first
+    rows = [dict(zip([rollupGroupColumns[table]] + rollupColumns,
+                     [group, queries, impact, round(cost, 2), round(impact_cost, 2), high, medium, low]))
+            for group, (queries, impact, cost, impact_cost, high, medium, low) in totals.items()]
+    return sorted(rows, key=lambda row: (-row['Impact Value'], str(row[rollupGroupColumns[table]])))
+##################################################################
+
+
+##################################################################
+def record_skipped_query(report, query, reason: str):
+    # List a query whose analysis couldn't be fetched in the Skipped report. The run state keeps it as
+    # unfinished, so that the next incremental run fetches it again rather than carrying it forward
+    cluster_id, query_id, cents, status, started = query
+    report['skipped'].append({'clusterId': cluster_id, 'id': query_id, 'Status': statusMapDict[status],
+                              'Reason': reason})
+    if report['state']:
+        key = query_key(cluster_id, query_id)
+        seen = report['previous'][key]['seen'] if key in report['previous'] else report['seen']
+        report['state'].write(json.dumps({'key': key, 'seen': seen, 'query': list(query), 'row': None,
+                                          'skipped': True}) + '\n')
+##################################################################
+
+
+##################################################################
+def close_report(report, completed: bool):
+    # Close the report files, and return the Top N rows of each ranking, sorted DESC
+    report['file'].close()
+    if report['journal']:
+        report['journal'].close()
+    if report['parquet']:
+        close_parquet_output(report['parquet'])
+    if report['state']:
+        report['state'].close()
+        if completed:
+            os.replace(report['state_file'] + '.tmp', report['state_file'])
+
+    return {
+        ranking: [row for value, rank, row in sorted(top_heap, key=lambda e: e[:2], reverse=True)]
+        for ranking, top_heap in report['top'].items()
+    }
+##################################################################
+
+
+##################################################################
+def write_checkpoint_header(checkpoint_file, header: dict):
+    # Start a new checkpoint journal with its header: the frozen work list and settings of this run
+    # The header is moved into place complete, so a crash while writing it leaves no half-written journal
+    checkpoint_file = os.path.expanduser(checkpoint_file)
+    os.makedirs(os.path.dirname(checkpoint_file) or '.', exist_ok=True)
+    with open(checkpoint_file + '.tmp', 'w') as f:
+        f.write(json.dumps(header) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+##################################################################
+
+
+##################################################################
+def journal_result(report, query, row=None, skip_reason=None, filtered=False, insights=None):
+    # Append a processed query to the checkpoint journal. Lines are flushed as written, so only a query being
+    # written at the moment of a crash can be lost, and it is simply fetched again on resume
+    if report['journal']:
+        entry = {'query': list(query), 'row': row}
+        if skip_reason:
+            entry['skipped'] = skip_reason
+        if filtered:
+            entry['filtered'] = True
+        if row and insights:
+            entry['insights'] = insights
+        report['journal'].write(json.dumps(entry, default=lambda o: o.item() if hasattr(o, 'item') else str(o)) +
+                                '\n')
+##################################################################
+
+
+##################################################################
+def load_checkpoint(checkpoint_file):
+    # Read the checkpoint journal of an interrupted run: its header, and the query results journaled so far,
+    # in the order they were recorded. Returns None if there is no usable journal
+    checkpoint_file = os.path.expanduser(checkpoint_file) if checkpoint_file else None
+    if not checkpoint_file or not os.path.isfile(checkpoint_file):
+        return None
+
+    with open(checkpoint_file, 'rb') as f:
+        header = f.readline()
+        try:
+            checkpoint = json.loads(header)
+        except ValueError:
+            return None
+        checkpoint['results'] = []
+        checkpoint['length'] = len(header)
+        for line in f:
+            try:
+                checkpoint['results'].append(json.loads(line))
+            except ValueError:
+                # The last line is cut short if the run was killed while writing it
+                break
+            checkpoint['length'] += len(line)
+
+    return checkpoint
+##################################################################
+
+
+##################################################################
+def resume_checkpoint(report, checkpoint_file, checkpoint):
+    # Carry on journaling to the checkpoint being resumed, after dropping any line cut short by the interruption
+    checkpoint_file = os.path.expanduser(checkpoint_file)
+    os.truncate(checkpoint_file, checkpoint['length'])
+    report['journal'] = open(checkpoint_file, 'a', buffering=1)
+##################################################################
+
+
+##################################################################
+def remove_checkpoint(checkpoint_file):
+    # A completed run has nothing left to resume
+    if checkpoint_file and os.path.isfile(os.path.expanduser(checkpoint_file)):
+        os.remove(os.path.expanduser(checkpoint_file))
+##################################################################
+
+
+##################################################################
+def split_previous_state(query_results: list, previous_state):
+    # Split the queries of the previous run into those whose results can be carried forward as-is,
+    # and those that were not yet finished and need to be fetched again along with the new queries.
+    # Queries that started before the lookback window are dropped, and unfinished queries that started more than
+    # recheckDays ago are carried forward as they were
+    window_start = datetime.fromisoformat(subtract_days_from_now(lookbackDays)).timestamp()
+    recheck_start = datetime.fromisoformat(subtract_days_from_now(recheckDays)).timestamp()
+    new_keys = set(query_key(result['clusterId'], result['id']) for result in query_results)
+    carried = {}
+    refetch = []
+
+    for key, entry in previous_state['queries'].items():
+        started = entry['query'][4] or datetime.fromisoformat(entry['seen']).timestamp()
+        if key in new_keys or started < window_start:
+            continue
+        # Queries the pre-filter left out are carried forward while it is still filtering, and fetched otherwise
+        if entry.get('filtered') and prefilterMode != 'filter':
+            refetch.append(entry['query'])
+        elif entry.get('skipped'):
+            refetch.append(entry['query'])
+        elif entry['query'][3] in terminalStatus or started < recheck_start:
+            carried[key] = entry
+        else:
+            refetch.append(entry['query'])
+
+    print("{}Carrying forward {} finished queries, re-fetching {} unfinished queries".format(
+        spacer, len(carried), len(refetch))
+    )
+    return query_results, carried, refetch
+##################################################################
+
+
+##################################################################
+def start_seconds(start_time):
+    # A query start time, as an ISO string or epoch milliseconds, in whole seconds since the epoch. 0 if unknown
+    if isinstance(start_time, (int, float)):
+        return int(start_time // 1000)
+    try:
+        return int(datetime.fromisoformat(start_time.replace('Z', '+00:00')).timestamp())
+    except (AttributeError, ValueError):
+        return 0
+##################################################################
+
+
+##################################################################
+def day_windows(started: list):
+    # Search windows of the days that queries started on, from their start times in seconds since the epoch,
+    # newest first
+    days = sorted(set(datetime.fromtimestamp(seconds).date() for seconds in started if seconds), reverse=True)
+    return [(datetime.combine(day, datetime.min.time()).isoformat(),
+             datetime.combine(day + timedelta(days=1), datetime.min.time()).isoformat()) for day in days]
+##################################################################
+
+
+##################################################################
+def recheck_unfinished(url, auth_token, unfinished: list):
+    # The queries that had not finished at the last run started before this run's search window, so search the
+    # days they started on again, to score them with their current status and cost
+    # Finished queries being fetched again, as their analysis was skipped or filtered out, aren't searched for, and
+    # queries that can't be found again keep the status and cost saved by the last run
+    wanted = set(query_key(query[0], query[1]) for query in unfinished if query[3] not in terminalStatus)
+    windows = day_windows([query[4] for query in unfinished if query[3] not in terminalStatus])
+
+    counts = [(window, record_count(url, auth_token, allow_empty=True, window=window, quiet=True))
+              for window in windows]
+    current = {}
+    for result in unified_search(url, auth_token, [(window, count) for window, count in counts if count]):
+        key = query_key(result['clusterId'], result['id'])
+        if key in wanted:
+            current[key] = result
+
+    print("{}Found {} of {} unfinished queries again, in {} days, to refresh their status and cost".format(
+        spacer, len(current), len(wanted), len(windows))
+    )
+    return [
+        current.get(query_key(cluster_id, query_id)) or
+        {'id': query_id, 'clusterId': cluster_id, 'cents': cents, 'status': status, 'started': started}
+        for cluster_id, query_id, cents, status, started in unfinished
+    ]
+##################################################################
+
+
+##################################################################
+def build_work_list(query_results: list):
+    # Hold the work list in compact typed columns: clusterId and status as categoricals, since only a handful
+    # of distinct values repeat across every query, cents as whole integer cents, and interned query ids
+    import pandas as pd
+
+    cents = pd.to_numeric(pd.Series([result['cents'] for result in query_results], dtype=object),
+                          errors='coerce')
+    return pd.DataFrame({
+        'id': [sys.intern(result['id']) if isinstance(result['id'], str) else result['id']
+               for result in query_results],
+        'clusterId': pd.Categorical([result['clusterId'] for result in query_results]),
+        'cents': cents.fillna(0).round().astype('int64'),
+        'status': pd.Categorical([result['status'] for result in query_results]),
+        'started': pd.Series([result['started'] for result in query_results], dtype='int64')
+    }, columns=baseLabels)
+##################################################################
+
+
+##################################################################
+def work_list_queries(df):
+    # Iterate the work list as (clusterId, id, cents, status, started) tuples of plain Python values, reading each
+    # column once rather than indexing the DataFrame per cell
+    return zip(df['clusterId'].tolist(), df['id'].tolist(), df['cents'].tolist(), df['status'].tolist(),
+               df['started'].tolist())
+##################################################################
+
+
+##################################################################
+def bounded_map(func, items, workers: int):
+    # Apply func to every item on a pool of worker threads, yielding results in input order.
+    # Only (2 x workers) calls are ever in flight, so long work lists never queue up in memory
+    workers = max(1, workers)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+##################################################################
+
+
+##################################################################
+def stream_projected_results(response, fields: list, header: dict = None):
+    # Incrementally parse a {..., "results": [{...}, ...], ...} body from the response stream, yielding only
+    # the projected fields of each result as it arrives. Only one result at a time is ever decoded, so the
+    # full body never exists as Python objects. Raises ValueError if the body is not a JSON object, or has no
+    # top-level "results" array. Given a header dict, the other top-level values are stored in it, as they are read
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = response.iter_content(chunk_size=65536)
+    buf = ''
+    pos = 0
+
+    def fill():
+        # Read the next chunk into the buffer, dropping what has already been parsed
+        nonlocal buf, pos
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buf = buf[pos:] + text_decoder.decode(chunk)
+        pos = 0
+        return True
+
+    def peek():
+        # The next non-whitespace character, reading more of the stream as needed
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                raise ValueError('Response body ended unexpectedly')
+
+    def expect(chars: str):
+        nonlocal pos
+        char = peek()
+        if char not in chars:
+            raise ValueError('Expected one of {!r} in response body, found {!r}'.format(chars, char))
+        pos += 1
+        return char
+
+    def value():
+        # Decode the next complete JSON value, reading more of the stream until it is complete
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                decoded, end = decoder.raw_decode(buf, pos)
+                # A number is only complete once followed by something else, as it may continue in the next chunk
+                if isinstance(decoded, (dict, list, str)) or (end < len(buf) and buf[end] not in '0123456789.eE+-'):
+                    pos = end
+                    return decoded
+            except ValueError:
+                pass
+            if not fill():
+                decoded, pos = decoder.raw_decode(buf, pos)
+                return decoded
+
+    expect('{')
+    found_results = False
+    while peek() != '}':
+        key = value()
+        expect(':')
+        if key == 'results' and peek() == '[':
+            found_results = True
+            expect('[')
+            if peek() != ']':
+                while True:
+                    result = value()
+                    if not isinstance(result, dict):
+                        raise ValueError('Expected a JSON object in "results", found {!r}'.format(result))
+                    yield {field: result.get(field) for field in fields}
+                    if expect(',]') == ']':
+                        break
+            else:
+                expect(']')
+        elif header is not None:
+            header[key] = value()
+        else:
+            value()
+        if expect(',}') == '}':
+            break
+    if not found_results:
+        raise ValueError('Response body has no "results" array')
+##################################################################
+
+
+##################################################################
+def unified_search_page(url, auth_token, window: tuple, page_from: int, page_size: int):
+    # Construct the UnifiedSearch API URL
+    search_url = url + '/api/v1/apps/unifiedsearch'
+
+    params_dict = {'from': page_from,
+                   'size': page_size,
+                   'start_time': window[0],
+                   'end_time': window[1],
                    'executed_by_unravel': False,
                    'appStatus': appStatus,
                    'appTypes': appTypes
                    }
 
-    print("{}Retrieving data for {} queries:".format(spacer, params_dict['size']))
+    # Query UnifiedSearch API for a single page, retrying only this page on failure
+    # Only the searchFields of each result are kept, as the page is streamed in
+    for attempt in range(1, pageRetries + 1):
+        response = authorised_request(
+            'unifiedsearch', 'POST',
+            search_url,
+            data=json.dumps(params_dict),
+            verify=False,
+            stream=True,
+            headers={'Authorization': auth_token,
+                     'Accept': 'application/json',
+                     'Content-Type': 'application/json'})
+
+        # Check the response status code and that we received a usable results block
+        # A page short of the expected number of results is retried too, so that no queries go missing, but is kept
+        # with a warning on the last attempt, as the window may simply hold fewer queries than when it was counted
+        results = None
+        if response.status_code == 200:
+            try:
+                results = list(stream_projected_results(response, searchFields))
+            except (ValueError, requests.exceptions.RequestException):
+                pass
+            finally:
+                record_bytes('unifiedsearch', response.raw.tell())
+                response.close()
+
+        if results is not None and (len(results) == page_size or attempt == pageRetries):
+            if len(results) < page_size:
+                print("{}WARNING: Page of {} queries from offset {} is still {} queries short, keeping {}".format(
+                    spacer, page_size, page_from, page_size - len(results), len(results))
+                )
+            return results
+
+        print("{}Page of {} queries from offset {} {} (attempt {} of {})".format(
+            spacer, page_size, page_from, 'failed' if results is None else 'was short', attempt, pageRetries)
+        )
+        if attempt < pageRetries:
+            time.sleep(retry_delay(attempt, response))
 
-    # Query UnifiedSearch API to get reference data on all queries
-    response = requests.post(
-        search_url,
-        data=json.dumps(params_dict),
-        verify=False,
-        headers={'Authorization': auth_token,
-                 'Accept': 'application/json',
-                 'Content-Type': 'application/json'})
+    print_api_debug_info('CRITICAL FAILURE!', response, 'initial query data', 'Exiting....')
+    exit(1)
+##################################################################
 
-    # Check the response status code
-    if response.status_code != 200:
-        print_api_debug_info('CRITICAL FAILURE!', response, 'initial query data', 'Exiting....')
-        exit(1)
 
-    return response
+##################################################################
+def unified_search(url, auth_token, counts: list):
+    # Walk the UnifiedSearch API in pages of searchPageSize for each window shard of counts, as returned by
+    # shard_counts(), fetching up to searchWorkers pages at once across all shards
+    # Projected results are yielded one at a time, newest shard first, and in the same order as a single request
+    # would return them within each shard. A query on the boundary of two shards is only yielded once
+    pages = [(window, page_from, min(searchPageSize, count - page_from))
+             for window, count in counts for page_from in range(0, count, searchPageSize)]
+
+    print("{}Retrieving data for {} queries, in {} pages of {}:".format(
+        spacer, sum(count for window, count in counts), len(pages), searchPageSize)
+    )
+
+    seen = set()
+    for page in bounded_map(lambda page: unified_search_page(url, auth_token, *page), pages, searchWorkers):
+        for result in page:
+            key = (result['clusterId'], result['id'])
+            if key not in seen:
+                seen.add(key)
+                result['started'] = start_seconds(result.pop('startTime'))
+                yield result
+##################################################################
+
+
+##################################################################
+def inefficient_apps_page(url, auth_token, window: tuple, page_from: int, page_size: int):
+    # Construct the Inefficient Apps API URL
+    apps_url = url + '/api/v1/apps/events/inefficient_apps_newux/'
+
+    params_dict = {'from': page_from,
+                   'size': page_size,
+                   'start_time': window[0],
+                   'end_time': window[1],
+                   'entityType': str(entityList)}
+
+    # Query the Inefficient Apps API for a single page, retrying only this page on failure
+    # Returns the page, with the total number of flagged queries, or None if the server doesn't say
+    for attempt in range(1, pageRetries + 1):
+        response = authorised_request(
+            'inefficientApps', 'GET',
+            apps_url,
+            params=params_dict,
+            verify=False,
+            stream=True,
+            headers={'Authorization': auth_token,
+                     'Accept': 'application/json'})
+
+        if response.status_code == 200:
+            try:
+                header = {}
+                page = list(stream_projected_results(response, ['clusterId', 'id'], header))
+                total = header.get('total')
+                if not isinstance(total, int) and isinstance(header.get('metadata'), dict):
+                    total = header['metadata'].get('total')
+                return page, total if isinstance(total, int) else None
+            except (ValueError, requests.exceptions.RequestException):
+                pass
+            finally:
+                record_bytes('inefficientApps', response.raw.tell())
+                response.close()
+
+        print("{}Page of {} flagged queries from offset {} failed (attempt {} of {})".format(
+            spacer, page_size, page_from, attempt, pageRetries)
+        )
+        if attempt < pageRetries:
+            time.sleep(retry_delay(attempt, response))
+
+    print_api_debug_info('CRITICAL FAILURE!', response, 'inefficient apps data', 'Exiting....')
+    exit(1)
+##################################################################
+
+
+##################################################################
+def flagged_queries(url, auth_token, windows: list):
+    # The query keys of every query the server flagged as inefficient within the search windows, walking each
+    # in pages of up to searchPageSize until its total is reached. The server may return smaller pages than
+    # asked for, so each page starts where the last one ended
+    flagged = set()
+    for window in windows:
+        page_from = 0
+        while True:
+            page, total = inefficient_apps_page(url, auth_token, window, page_from, searchPageSize)
+            flagged.update(query_key(result['clusterId'], result['id']) for result in page)
+            page_from += len(page)
+            if not page or (page_from >= total if total is not None else len(page) < searchPageSize):
+                break
+        if total is not None and page_from < total:
+            print("{}WARNING: only {} of {} flagged queries were returned for {} to {}".format(
+                spacer, page_from, total, window[0], window[1])
+            )
+
+    print("{}{} queries were flagged as inefficient by the server".format(spacer, len(flagged)))
+    return flagged
+##################################################################
+
+
+##################################################################
+def count_prefilter(flagged, query, row):
+    # Tally a scored query against the pre-filter: the analysis requests it saves, and the report rows it misses
+    if flagged is None:
+        return
+    if query_key(query[0], query[1]) in flagged:
+        prefilterStats['flagged'] += 1
+        return
+
+    prefilterStats['unflagged'] += 1
+    if row:
+        prefilterStats['missed_rows'] += 1
+        prefilterStats['missed_impact'] += row['Impact Value']
+        prefilterStats['missed_cost'] = round(prefilterStats['missed_cost'] + row['Cost (USD)'], 2)
+        prefilterStats['missed_high'] += int(row['High Impact'] > 0)
+##################################################################
+
+
+##################################################################
+def reset_fetch_limiter():
+    # Start Stage 5 at full concurrency, with no latency history
+    with fetchLimiterCondition:
+        fetchLimiter.clear()
+        fetchLimiter.update({'limit': float(max(1, fetchWorkers)), 'in_flight': 0, 'latency': None, 'best': None,
+                             'last_decrease': 0.0, 'lowest': max(1, fetchWorkers), 'decreases': 0, 'retries': 0})
+##################################################################
+
+
+##################################################################
+def acquire_fetch_slot():
+    # Wait until fewer than the current limit of analysis requests are in flight
+    with fetchLimiterCondition:
+        while fetchLimiter['in_flight'] >= int(fetchLimiter['limit']):
+            fetchLimiterCondition.wait()
+        fetchLimiter['in_flight'] += 1
+##################################################################
+
+
+##################################################################
+def release_fetch_slot(seconds: float, overloaded: bool):
+    # Adjust the concurrency limit on the outcome of a request: multiplicative decrease when the server is
+    # overloaded or slowing down, additive increase (one per round of limit requests) when it is healthy
+    with fetchLimiterCondition:
+        fetchLimiter['in_flight'] -= 1
+        if not overloaded:
+            latency = fetchLimiter['latency']
+            fetchLimiter['latency'] = seconds if latency is None else 0.8 * latency + 0.2 * seconds
+            fetchLimiter['best'] = min(fetchLimiter['best'] or fetchLimiter['latency'], fetchLimiter['latency'])
+            overloaded = bool(latencyTolerance) and fetchLimiter['latency'] > latencyTolerance * fetchLimiter['best']
+
+        if overloaded:
+            # Only decrease once per round trip, as the requests already in flight will report the same trouble
+            now = time.perf_counter()
+            if now - fetchLimiter['last_decrease'] > (fetchLimiter['latency'] or 0):
+                fetchLimiter['limit'] = max(float(max(1, minFetchWorkers)), fetchLimiter['limit'] / 2)
+                fetchLimiter['last_decrease'] = now
+                fetchLimiter['decreases'] += 1
+                fetchLimiter['lowest'] = min(fetchLimiter['lowest'], int(fetchLimiter['limit']))
+        else:
+            fetchLimiter['limit'] = min(float(max(1, fetchWorkers)), fetchLimiter['limit'] + 1 / fetchLimiter['limit'])
+        fetchLimiterCondition.notify_all()
+##################################################################
+
+
+##################################################################
+def retry_delay(attempt: int, response=None):
+    # Exponential backoff with full jitter, but never sooner than the server asked for with Retry-After
+    delay = random.uniform(0, min(retryMaxDelay, retryBaseDelay * 2 ** (attempt - 1)))
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        delay = max(delay, min(retryMaxDelay, int(retry_after)))
+    return delay
+##################################################################
+
+
+##################################################################
+def get_query_entities(i_base_url, headers_dict, query, cache_conn=None):
+    # Fetch the analysis for a single query, retrying transient errors
+    # Returns (analysis, None), with analysis None if the query has no insights,
+    # or (None, reason) if the analysis couldn't be fetched and the query was skipped
+    cluster_id, query_id, cents, status, started = query
+    url = i_base_url + platformAdapters[platform]['analysis'].format(cluster_id=cluster_id, query_id=query_id)
+
+    # Only finished queries are cached. Running/Pending queries are always fetched again
+    cacheable = cache_conn is not None and status in terminalStatus
+    entities_body = get_cached_analysis(cache_conn, cluster_id, query_id) if cacheable else None
+    from_cache = entities_body is not None
+
+    for attempt in range(1, max(1, analysisRetries) + 1):
+        if from_cache:
+            break
+
+        acquire_fetch_slot()
+        started = time.perf_counter()
+        try:
+            entities_response = authorised_request('analysis', 'GET', url, verify=False, headers=headers_dict)
+        except requests.exceptions.RequestException as e:
+            entities_response = None
+            skip_reason = 'No response: {}'.format(type(e).__name__)
+        release_fetch_slot(time.perf_counter() - started,
+                           entities_response is None or entities_response.status_code in transientStatus)
+
+        if entities_response is not None:
+            # Keep the raw bytes, so the body is never decoded to text before parsing
+            if entities_response.status_code == 200:
+                entities_body = entities_response.content
+                break
+
+            skip_reason = 'HTTP {}'.format(entities_response.status_code)
+            if debug:
+                print_api_debug_info('WARNING!', entities_response, 'entity metadata', 'Skipping....')
+            if entities_response.status_code not in transientStatus:
+                return None, skip_reason
+
+        if attempt < max(1, analysisRetries):
+            with fetchLimiterCondition:
+                fetchLimiter['retries'] += 1
+            time.sleep(retry_delay(attempt, entities_response))
+    else:
+        return None, '{}, after {} attempts'.format(skip_reason, max(1, analysisRetries))
+
+    # Skip this query if no data contained in query response
+    if len(entities_body) == 0:
+        return None, 'Empty analysis response'
+
+    # Now serialise our response data
+    try:
+        entities = json_loads(entities_body)
+    except ValueError:
+        return None, 'Analysis response is not valid JSON'
+    if not isinstance(entities, dict):
+        return None, 'Analysis response is not a JSON object'
+    # Only a usable analysis is cached, so that a bad one is fetched again rather than failing every later run
+    if not isinstance(entities.get('insightsV2'), list):
+        return None, 'Analysis response has no "insightsV2" list'
+
+    if cacheable and not from_cache:
+        put_cached_analysis(cache_conn, cluster_id, query_id, entities_body)
+
+    # Skip this query if no "insightsV2' data contained in query response
+    if len(entities['insightsV2']) == 0:
+        return None, None
+
+    return entities, None
+##################################################################
+
+
+##################################################################
+def impact_bands(impact):
+    # Impact Labels: High is above 70, Medium is 31 to 70, and everything else is Low
+    # Returns the (High, Medium) flags of an impact, or the flag arrays of a NumPy array of impacts
+    return impact > 70, (impact > 30) & (impact < 71)
 ##################################################################
 
 
 ##################################################################
-def get_entitiesV2(i_base_url, auth_token, df):
-    entitiesV2List = []
+def score_entities(i_base_url, batch: list):
+    # Score a batch of (query, analysis) pairs in one vectorised pass
+    # Returns the report row for each query, in batch order, or None where the query is to be discarded, and the
+    # [name, impact] pairs of the insights of every "insightsV2" entry of each query, with the insight's own impact
+    import numpy as np
+
+    # Flatten every insight category of the batch into columnar arrays
+    query_index, entry_index, insight_names, impacts, instance_counts = [], [], [], [], []
+    last_entry = np.full(len(batch), -1)
+    entry_count = 0
+    for q, (query, entities) in enumerate(batch):
+        if entities is None:
+            continue
+        for ent in entities['insightsV2']:
+            for insight_name, category in ent['categories'].items():
+                query_index.append(q)
+                entry_index.append(entry_count)
+                insight_names.append(insight_name)
+                impacts.append(int(category['impact']))
+                instance_counts.append(len(category['instances']))
+            last_entry[q] = entry_count
+            entry_count += 1
+
+    query_index = np.array(query_index, dtype=np.int64)
+    entry_index = np.array(entry_index, dtype=np.int64)
+    impacts = np.array(impacts, dtype=np.int64)
+
+    # Each insight is scored on the running total of impacts within its "insightsV2" entry
+    running_total = np.cumsum(impacts)
+    entry_starts = np.ones(len(impacts), dtype=bool)
+    entry_starts[1:] = entry_index[1:] != entry_index[:-1]
+    start_position = np.maximum.accumulate(np.where(entry_starts, np.arange(len(impacts)), 0))
+    insight_impact = running_total - (running_total - impacts)[start_position]
+
+    high, medium = impact_bands(insight_impact)
+    impact_value = np.bincount(query_index, weights=insight_impact, minlength=len(batch)).astype(np.int64)
+    high_count = np.bincount(query_index[high], minlength=len(batch))
+    medium_count = np.bincount(query_index[medium], minlength=len(batch))
+    low_count = np.bincount(query_index[~(high | medium)], minlength=len(batch))
+    instance_count = np.bincount(query_index, weights=instance_counts, minlength=len(batch)).astype(np.int64)
+
+    # Only the insights of the last "insightsV2" entry of a query are listed in the report, but the insights of
+    # every entry are rolled up
+    insights_labels = [[] for _ in batch]
+    for i in np.flatnonzero(entry_index == last_entry[query_index]):
+        insights_labels[query_index[i]].append('{} ({})'.format(insight_names[i], insight_impact[i]))
+    insight_impacts = [[] for _ in batch]
+    for i in range(len(impacts)):
+        insight_impacts[query_index[i]].append([insight_names[i], int(impacts[i])])
+
+    rows = []
+    for q, (query, entities) in enumerate(batch):
+        # Filter out rows if total query 'Impact Value' is less than 30
+        if entities is None or impact_value[q] < 30:
+            rows.append(None)
+            continue
+
+        cluster_id, query_id, cents, status, started = query
+        rows.append({
+            'clusterId': cluster_id,
+            'id': query_id,
+            'Unravel UI link': i_base_url + platformAdapters[platform]['ui_link'].format(
+                cluster_id=cluster_id, query_id=query_id
+            ),
+            'Cost (USD)': cents / 100,
+            'Status': statusMapDict[status],
+            'Impact Value': int(impact_value[q]),
+            'High Impact': int(high_count[q]),
+            'Medium Impact': int(medium_count[q]),
+            'Low Impact': int(low_count[q]),
+            'Instance Count': int(instance_count[q]),
+            'Insights': insights_labels[q]
+        })
+
+        if debug:
+            print("{}Here is the results of our dictionary:\n\t{}".format(spacer, rows[-1]))
+
+    return rows, insight_impacts
+##################################################################
+
+
+##################################################################
+def record_scored_batch(i_base_url, report, batch: list, flagged=None):
+    # Score a batch of (query, analysis) pairs, and record each query in the report, run state and journal
+    rows, insight_impacts = score_entities(i_base_url, batch)
+    for (query, entities), entities_dict, insights in zip(batch, rows, insight_impacts):
+        record_query(report, query, entities_dict, insights=insights)
+        journal_result(report, query, entities_dict, insights=insights)
+        count_prefilter(flagged, query, entities_dict)
+##################################################################
+
+
+##################################################################
+def get_entitiesV2(i_base_url, auth_token, df, report, cache_conn=None, flagged=None):
+    # Given the set of flagged query keys, only flagged queries are fetched in 'filter' mode, and the queries
+    # fetched are checked against it in 'verify' mode
     headers_dict = {'Authorization': auth_token,
                     'Accept': 'application/json'}
 
-    print("{}Retrieving Entity data for {} records".format(spacer, df.shape[0]))
+    print("{}Retrieving Entity data for {} records, using {} to {} workers".format(
+        spacer, df.shape[0], max(1, minFetchWorkers), fetchWorkers)
+    )
 
-    # The following section is hard coded for Unravel for Google Bigquery
-    # Please advise if you have requirements for other supported platforms
+    # The analysis endpoint and UI link of each platform are set in platformAdapters
     if debug:
         print("{}Processing {} records".format(spacer, df.shape[0]))
         print("{}Number of variables: {}".format(spacer, df.shape[1]))
@@ -320,198 +1954,677 @@ def get_entitiesV2(i_base_url, auth_token, df):
         df.to_csv(out_file, index=False)
 
     # queryCount = df.shape[0]
-    for i in df.index:
-        url = i_base_url + '/api/v1/bigquery/{}/{}/analysis'.format(df['clusterId'][i], df['id'][i])
-        link_url = i_base_url + '/#/app/application/apptype/bigquery?execId={}&projectId={}'.format(
-            df['id'][i], df['clusterId'][i]
+    # Fetch analysis concurrently. Results come back in dataframe order, so the report is
+    # identical to fetching one query at a time
+    # Analysis is scored in batches of scoreBatchSize queries as it arrives
+    # Queries whose analysis couldn't be fetched are not scored, and are fetched again by the next incremental run
+    # Queries left out by the pre-filter are recorded without a request
+    def fetch(query):
+        if prefilterMode == 'filter' and query_key(query[0], query[1]) not in flagged:
+            return query, None
+        return query, get_query_entities(i_base_url, headers_dict, query, cache_conn)
+
+    queries = work_list_queries(df)
+    batch = []
+    reset_fetch_limiter()
+    cacheStats.update({'hits': 0, 'stores': 0})
+    prefilterStats.update({'flagged': 0, 'unflagged': 0, 'missed_rows': 0, 'missed_impact': 0, 'missed_cost': 0.0,
+                           'missed_high': 0})
+    for query, fetched in bounded_map(fetch, queries, fetchWorkers):
+        if fetched is None:
+            record_query(report, query, None, filtered=True)
+            journal_result(report, query, filtered=True)
+            count_prefilter(flagged, query, None)
+            continue
+        entities, skip_reason = fetched
+        if skip_reason:
+            record_skipped_query(report, query, skip_reason)
+            journal_result(report, query, skip_reason=skip_reason)
+            continue
+        batch.append((query, entities))
+        if len(batch) >= scoreBatchSize:
+            record_scored_batch(i_base_url, report, batch, flagged)
+            batch = []
+
+    record_scored_batch(i_base_url, report, batch, flagged)
+
+    if cache_conn is not None:
+        print("{}Analysis cache: {} queries served from cache, {} newly cached".format(
+            spacer, cacheStats['hits'], cacheStats['stores'])
         )
-        entities_response = requests.get(url, verify=False, headers=headers_dict)
+        prune_analysis_cache(cache_conn)
 
-        # Check the response status code
-        if entities_response.status_code != 200:
-            # Print debug info
-            print_api_debug_info('WARNING!', response, 'entity metadata', 'Skipping....')
+    print("{}Analysis concurrency: limit ended at {}, lowest {}, reduced {} times, with {} retries".format(
+        spacer, int(fetchLimiter['limit']), fetchLimiter['lowest'], fetchLimiter['decreases'], fetchLimiter['retries'])
+    )
+    print("{}Scored {} queries, of which {} were added to the report".format(
+        spacer, report['queries'], report['rows'])
+    )
+    if prefilterMode == 'filter':
+        print("{}Pre-filter: fetched the analysis of {} flagged queries, and saved {} analysis requests".format(
+            spacer, prefilterStats['flagged'], prefilterStats['unflagged'])
+        )
+    elif prefilterMode == 'verify':
+        scored = prefilterStats['flagged'] + prefilterStats['unflagged']
+        print("{}Pre-filter check: {} of {} queries were flagged, so the filter would have saved {} analysis "
+              "requests ({:.1%})".format(spacer, prefilterStats['flagged'], scored, prefilterStats['unflagged'],
+                                         prefilterStats['unflagged'] / max(scored, 1)))
+        print("{}Pre-filter check: it would have missed {} report rows ({} with High impact insights), "
+              "with a total Impact Value of {} and cost of ${:.2f}".format(
+                spacer, prefilterStats['missed_rows'], prefilterStats['missed_high'],
+                prefilterStats['missed_impact'], prefilterStats['missed_cost']))
+    if report['skipped']:
+        print("{}WARNING: {} queries were skipped, as their analysis couldn't be fetched".format(
+            spacer, len(report['skipped']))
+        )
+##################################################################
 
-            # Exit this loop iteration if we can't collect entity metadata
-            continue
 
-        # Exit this loop iteration if no data contained in query response
-        # if len(entities_response.text) == 0:
-        if not isinstance(entities_response.json(), dict) or len(entities_response.text) == 0:
-            continue
+##################################################################
+def collect_report(out_file, run_timestamp: str, checkpoint=None):
+    # Stages 1 to 5 for the configured Unravel instance: write the full report to out_file as queries are
+    # scored, and return the report summary along with its Top N rows of each ranking
+    # Given the checkpoint of an interrupted run, its work list is used in place of Stages 2 to 4, and only
+    # the queries it had not yet processed are fetched
+    global start_time
+
+    # In incremental mode, start the lookback window at the end of the last successful run
+    previous_state = load_report_state(stateFile) if incrementalMode else None
+    if checkpoint:
+        start_time = checkpoint['start_time']
+        print("Resuming the interrupted run, which collected queries since {}".format(start_time))
+    elif previous_state:
+        start_time = previous_state['end_time']
+        print("Incremental run: collecting queries since {}".format(start_time))
+    else:
+        start_time = subtract_days_from_now(lookbackDays)
+        if incrementalMode:
+            print("Incremental run: no previous run state found, so collecting the full {} days".format(lookbackDays))
 
-        # Now serialise our response data
-        entities = json.loads(entities_response.text)
+    # Get auth_token
+    begin_stage("Stage 1: Generating authentication token")
+    auth_token = get_auth_token(platform, usernameEnv, passwordEnv)
+
+    if checkpoint:
+        begin_stage("Stage 2-4: Restoring the work list of the interrupted run")
+        carried = checkpoint['carried']
+        processed = set(query_key(result['query'][0], result['query'][1]) for result in checkpoint['results'])
+        df = build_work_list([
+            {'id': query_id, 'clusterId': cluster_id, 'cents': cents, 'status': status, 'started': started}
+            for cluster_id, query_id, cents, status, started in checkpoint['work']
+            if query_key(cluster_id, query_id) not in processed
+        ])
+        print("{}{} of {} queries were already processed, {} remain".format(
+            spacer, len(checkpoint['results']), len(checkpoint['work']), df.shape[0])
+        )
+    else:
+        # Get a count of available queries
+        begin_stage("Stage 2: Getting record count")
+        recordCounts = shard_counts(base_url, auth_token, allow_empty=bool(previous_state))
+        # recordCount = 19000
+
+        # Get Query data from UnifiedSearch API
+        begin_stage("Stage 3: Getting query IDs")
+        import pandas as pd
+
+        # Prevent interpreter complaining about wobbly file handles
+        pd.options.mode.chained_assignment = None
+
+        query_results = list(unified_search(base_url, auth_token, recordCounts))
+        if len(query_results) == 0 and not previous_state:
+            print("{}Unfortunately, we received no required data".format(spacer))
+            print("{}Response field \"results\" was empty in every page of the API response".format(spacer))
+            print("{}Exiting, sorry......".format(spacer))
+            exit(1)
+        print("{}Received {} query results".format(spacer, len(query_results)))
+        # exit()
+
+        # The required fields were already extracted as each page streamed in
+        begin_stage("Stage 4: Extracting required fields from API response data")
+        carried = {}
+        if previous_state:
+            query_results, carried, unfinished = split_previous_state(query_results, previous_state)
+            if unfinished:
+                query_results.extend(recheck_unfinished(base_url, auth_token, unfinished))
+
+        df = build_work_list(query_results)
+        query_results = None
 
-        # Exit this loop iteration if no "insightsV2' data contained in query response
-        if len(entities['insightsV2']) == 0:
-            continue
+    if debug:
+        print("{}Unified Search dataframe columns: {}".format(spacer, list(df.columns)))
+        print("{}Work list uses {} bytes per query".format(
+            spacer, df.memory_usage(index=False, deep=True).sum() // max(df.shape[0], 1))
+        )
 
-        # Initialise dict to hold all data for each report query
-        entities_dict = {
-            'clusterId': df['clusterId'][i],
-            'id': df['id'][i],
-            'Unravel UI link': link_url,
-            'Cost (USD)': round(df['cents'][i])/100,
-            'Status': statusMapDict[df['status'][i]],
-            'Impact Value': 0,
-            # 'Insights Count': 0,
-            'High Impact': 0,
-            'Medium Impact': 0,
-            'Low Impact': 0,
-            'Instance Count': 0
-        }
+    # Get entity data for queries in dataframe, writing the full report as we go
+    begin_stage("Stage 5: Begin collecting query entity data")
+    report = open_report(out_file, stateFile, previous_state)
+
+    # Journal the frozen work list first, or carry on with the journal being resumed.
+    # Either way the report is rebuilt in the same order as an uninterrupted run
+    if checkpoint:
+        report['seen'] = checkpoint['seen']
+        resume_checkpoint(report, checkpointFile, checkpoint)
+    elif checkpointFile:
+        write_checkpoint_header(checkpointFile, {
+            'end_time': end_time, 'run_timestamp': run_timestamp, 'start_time': start_time, 'seen': report['seen'],
+            'carried': carried, 'work': [list(query) for query in work_list_queries(df)]
+        })
+        report['journal'] = open(os.path.expanduser(checkpointFile), 'a', buffering=1)
+
+    # Results carried forward from the previous run go into the report first
+    for entry in carried.values():
+        record_query(report, entry['query'], entry['row'], entry['seen'], entry.get('filtered', False),
+                     entry.get('insights'))
+
+    # Then the results the interrupted run had already processed
+    if checkpoint:
+        for result in checkpoint['results']:
+            if 'skipped' in result:
+                record_skipped_query(report, tuple(result['query']), result['skipped'])
+            else:
+                record_query(report, tuple(result['query']), result['row'],
+                             filtered=result.get('filtered', False), insights=result.get('insights'))
+
+    # Queries carried over from the last run that are in the work list again started before this run's search
+    # window, so the days they started on are checked for flags too
+    flagged = None
+    if prefilterMode:
+        window_start = datetime.fromisoformat(start_time).timestamp()
+        flagged = flagged_queries(base_url, auth_token, search_windows() + day_windows(
+            [started for started in df['started'].tolist() if started < window_start]
+        ))
+    cache_conn = open_analysis_cache(cacheFile)
+    completed = False
+    try:
+        get_entitiesV2(base_url, auth_token, df, report, cache_conn, flagged)
+        completed = True
+    finally:
+        top_rows = close_report(report, completed)
+        if cache_conn is not None:
+            cache_conn.close()
+    if authState.get('refreshes'):
+        print("{}Authentication token was refreshed {} times during the run".format(spacer, authState['refreshes']))
+    print("{}Collection of query entity data completed".format(spacer))
 
-        for ent in entities['insightsV2']:
-            # Every key is a unique Insight name, so collect all 'categories''key' values
-            insights_list = list(ent['categories'].keys())
-            # entities_dict['Insights Count'] = len(insights_list)
-            impact_value = 0
-            ext_insights_labels = []
-            for x in insights_list:
-                impact_value = impact_value + int(ent['categories'][x]['impact'])
-
-                # Add Impact score for Insight to Insight label
-                label_name = '{} ({})'.format(x, impact_value)
-                ext_insights_labels.append(label_name)
-
-                # Summation of 'Impact Value'
-                entities_dict['Impact Value'] = entities_dict['Impact Value'] + impact_value
-
-                # Impact Labels
-                # Assign Impact Label to 'Impact Value' and then increment label counter
-                impact_label = get_impact_label(int(impact_value))
-                if impact_label == 'High':
-                    entities_dict['High Impact'] += 1
-                elif impact_label == 'Medium':
-                    entities_dict['Medium Impact'] += 1
-                else:
-                    entities_dict['Low Impact'] += 1
-
-                # 'Instance Count'
-                # Keep tally of all potential inefficiency points
-                entities_dict['Instance Count'] = entities_dict['Instance Count'] + len(ent['categories'][x]['instances'])
-
-            entities_dict['Insights'] = ext_insights_labels
+    return {'rows': report['rows'], 'queries': report['queries'], 'skipped': report['skipped'],
+            'rollups': {table: rollup_rows(table, totals) for table, totals in report['rollups'].items()}}, top_rows
+##################################################################
 
-            if debug:
-                print("{}Categories: count: {}, values: {}".format(spacer, len(insights_list), str(insights_list)))
-                print("{}Here is the results of our dictionary:\n\t{}".format(spacer, entities_dict))
 
-        # Filter out rows if total query 'Impact Value' is less than 30
-        if entities_dict['Impact Value'] < 30:
-            if debug:
-                print("{}Nothing to see here. Discarding this query".format(spacer))
-            entities_dict = {}
-            continue
+##################################################################
+def target_file(file_name, target_name: str):
+    # Per-target variant of a configured file, e.g. Analysis_Cache.sqlite => Analysis_Cache-gcp-bq.sqlite
+    if not file_name:
+        return file_name
+    root, extension = os.path.splitext(file_name)
+    return '{}-{}{}'.format(root, target_name, extension)
+##################################################################
+
 
-        entitiesV2List.append(entities_dict)
-        entities_dict = {}
+##################################################################
+def target_defaults():
+    # The settings of the main process that run_target() points at each target
+    return {'urlsDict': dict(urlsDict), 'usernameEnv': usernameEnv, 'passwordEnv': passwordEnv,
+            'cacheFile': cacheFile, 'stateFile': stateFile, 'checkpointFile': checkpointFile,
+            'tokenCacheFile': tokenCacheFile, 'parquetDir': parquetDir}
+##################################################################
 
-    # Sort results on 'Impact Value', DESC to generate "Top 10" report
-    entitiesV2List_sorted = sorted(entitiesV2List, key=lambda l: l['Impact Value'], reverse=True)
-    entitiesV2List = []
-    print("{}Our EntitiesV2 sorted list has a size of: {} kB".format(
-        spacer, round(asizeof.asizeof(entitiesV2List_sorted) / 1024))
+
+##################################################################
+def run_target(target: dict, defaults: dict, run_end_time: str, run_timestamp: str, resume=False):
+    # Collect the report of a single target, in a worker process. The module-level settings of this process are
+    # pointed at the target, and everything it prints goes to the target's log file
+    # Settings are derived from defaults, the settings of the main process, rather than the current ones, as a
+    # worker process may already have collected another target
+    global platform, base_url, appTypes, usernameEnv, passwordEnv, end_time, cacheFile, stateFile, parquetDir
+    global checkpointFile, tokenCacheFile
+    global httpSession
+
+    name = target['name']
+    platform = target['platform']
+    base_url = target['url'].rstrip('/')
+    urlsDict.clear()
+    urlsDict.update(defaults['urlsDict'], **{platform: base_url})
+    appTypes = target.get('appTypes', platformAdapters[platform]['appTypes'])
+    usernameEnv = target.get('username_env', defaults['usernameEnv'])
+    passwordEnv = target.get('password_env', defaults['passwordEnv'])
+    end_time = run_end_time
+    cacheFile = target_file(defaults['cacheFile'], name)
+    stateFile = target_file(defaults['stateFile'], name)
+    checkpointFile = target_file(defaults['checkpointFile'], name)
+    tokenCacheFile = target_file(defaults['tokenCacheFile'], name)
+    parquetDir = os.path.join(defaults['parquetDir'], 'target={}'.format(quote(name, safe='')))
+
+    # A worker starts with a copy of the parent's state, or that of the last target it collected,
+    # which must not be shared
+    httpSession = None
+    del stageMetrics[:]
+    requestMetrics.clear()
+    with authLock:
+        authState.clear()
+
+    out_file = dataDir + '/Impact_Report-{}-{}.csv{}'.format(
+        name, run_timestamp, compressionSuffixes[reportCompression]
     )
+    log_file = os.path.expanduser(dataDir + '/Impact_Report-{}-{}.log'.format(name, run_timestamp))
+    os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+    result = {'name': name, 'out_file': out_file, 'log_file': log_file, 'failed': True}
+
+    with open(log_file, 'w', buffering=1) as log, redirect_stdout(log):
+        print("Target {}: {} instance at {}".format(name, platform, base_url))
+        try:
+            checkpoint = load_checkpoint(checkpointFile) if resume else None
+            if checkpoint and 'work' not in checkpoint:
+                checkpoint = None
+            summary, top_rows = collect_report(out_file, run_timestamp, checkpoint)
+        except (SystemExit, requests.exceptions.RequestException) as e:
+            print("{}Collection for target {} failed: {}".format(spacer, name, e or 'see above'))
+            return result
+
+        begin_stage("Stage 6: Target collection completed!")
+        print_stage_metrics()
+        if metricsOutput:
+            write_run_metrics(dataDir + '/Impact_Report-Metrics-{}-{}'.format(name, run_timestamp),
+                              format_run_metrics())
+
+    for rows in top_rows.values():
+        for row in rows:
+            row['Target'] = name
+    result.update(summary, top=top_rows, failed=False)
+    return result
+##################################################################
+
 
-    return entitiesV2List_sorted
+##################################################################
+def read_report_file(out_file):
+    # Open a full report CSV for reading as text, decompressing as set by reportCompression
+    if reportCompression == 'gzip':
+        return gzip.open(out_file, 'rt', newline='')
+    if reportCompression == 'zstd':
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(out_file, 'rb')), newline='')
+    return open(out_file, newline='')
 ##################################################################
 
 
 ##################################################################
-def main():
-    # Get auth_token
-    print("Stage 1: Generating authentication token")
-    auth_token = get_auth_token(platform)
-
-    # Get a count of available queries
-    print("Stage 2: Getting record count")
-    recordCount = record_count(base_url, auth_token)
-    # recordCount = 19000
-
-    # Get Query data from UnifiedSearch API
-    discount = 5
-    print("Stage 3: Getting query IDs")
-    query_data = unified_search(base_url, auth_token, recordCount)
-    while not isinstance(query_data.json(), dict):
-        newRecordCount = round(recordCount * ((100 - discount) / 100))
-        print("{}Incorrect data type returned. Reducing requested record count by {}%".format(spacer, discount))
-        query_data = unified_search(base_url, auth_token, newRecordCount)
-        discount += 5
-
-    if newRecordCount:
-        print("{}Our API query of {} results set has a size of: {} kB".format(
-            spacer, newRecordCount, round(asizeof.asizeof(query_data.json()) / 1024)))
-    else:
-        print("{}Our API query of {} results set has a size of: {} kB".format(
-            spacer, recordCount, round(asizeof.asizeof(query_data.json()) / 1024)))
-    if 'results' not in query_data.json().keys() or len(query_data.json()['results']) == 0:
-        print("{}Unfortunately, we received no required data".format(spacer))
-        print("{}Response field \"results\" missing from API response".format(spacer))
-        print("{}API response contained these fields: {}".format(spacer, list(query_data.json().keys())))
-        print("{}Exiting, sorry......".format(spacer))
-        exit(1)
+def collect_targets(out_file, run_timestamp: str, checkpoint=None):
+    # Stages 1 to 5 for every configured target, targetWorkers at a time, each in its own worker process.
+    # The target reports are then merged into the combined report at out_file, and their Top N rows into
+    # the global Top N. A target that fails is left out of the combined report
+    # The result of every completed target is journaled to the run's checkpoint, so that given the checkpoint of
+    # an interrupted run, only the targets it did not complete are collected again
+    completed = {result['name']: result for result in checkpoint['results']} if checkpoint else {}
+    pending = [target for target in targets if target['name'] not in completed]
+    journal = None
+    if checkpointFile:
+        if checkpoint:
+            os.truncate(os.path.expanduser(checkpointFile), checkpoint['length'])
+        journal = open(os.path.expanduser(checkpointFile), 'a', buffering=1)
+
+    begin_stage("Stage 1-5: Collecting {} targets, using {} worker processes".format(
+        len(pending), min(targetWorkers, len(pending)))
+    )
+    if completed:
+        print("{}Reusing the reports of {} targets completed by the interrupted run: {}".format(
+            spacer, len(completed), ', '.join(completed))
+        )
+    with ProcessPoolExecutor(max_workers=max(1, min(targetWorkers, len(pending)))) as executor:
+        defaults = target_defaults()
+        futures = {target['name']: executor.submit(run_target, target, defaults, end_time, run_timestamp,
+                                                   bool(checkpoint))
+                   for target in pending}
+        results = []
+        for target in targets:
+            if target['name'] in completed:
+                results.append(completed[target['name']])
+                continue
+            try:
+                result = futures[target['name']].result()
+            except Exception as e:
+                print("{}Collection for target {} failed: {}".format(spacer, target['name'], e))
+                result = {'name': target['name'], 'failed': True, 'log_file': None}
+            if journal and not result['failed']:
+                journal.write(json.dumps(result, default=lambda o: o.item() if hasattr(o, 'item') else str(o)) +
+                              '\n')
+            results.append(result)
+    if journal:
+        journal.close()
+
+    summary = {'rows': 0, 'queries': 0, 'skipped': [], 'rollups': {table: [] for table in rollupTables},
+               'failed_targets': []}
+    top_rows = {ranking: [] for ranking in topRankings}
+    os.makedirs(os.path.dirname(os.path.expanduser(out_file)) or '.', exist_ok=True)
+    with open_report_file(os.path.expanduser(out_file)) as combined:
+        writer = csv.DictWriter(combined, fieldnames=['Target'] + reportColumns, lineterminator='\n')
+        writer.writeheader()
+        for result in results:
+            if result['failed']:
+                see_log = '. See log:\n\t\t {}'.format(result['log_file']) if result['log_file'] else ''
+                print("{}Target {} FAILED, and is not in the combined report{}".format(spacer, result['name'], see_log))
+                summary['failed_targets'].append(result['name'])
+                continue
+            print("{}Target {}: {} records of {} queries. See log:\n\t\t {}".format(
+                spacer, result['name'], result['rows'], result['queries'], result['log_file'])
+            )
+
+            # Copy the target's report into the combined report, one row at a time
+            with read_report_file(os.path.expanduser(result['out_file'])) as f:
+                for row in csv.DictReader(f):
+                    row['Target'] = result['name']
+                    writer.writerow(row)
+            summary['rows'] += result['rows']
+            summary['queries'] += result['queries']
+            for skipped in result['skipped']:
+                skipped['Target'] = result['name']
+            summary['skipped'].extend(result['skipped'])
+            # Rollups are kept per target, as neither clusters nor insights are comparable between instances
+            for table, rows in result['rollups'].items():
+                for row in rows:
+                    row['Target'] = result['name']
+                summary['rollups'][table].extend(rows)
+            for ranking in topRankings:
+                top_rows[ranking].extend(result['top'][ranking])
+
+    # The global Top N is the Top N of every target's own Top N. Ties keep target order
+    for ranking in topRankings:
+        top_rows[ranking] = sorted(top_rows[ranking], key=rankingKeys[ranking], reverse=True)[:topCount]
+
+    return summary, top_rows
+##################################################################
 
-    # Store API response as DataFrame
-    temp_df = pd.DataFrame(query_data.json()['results'])
-    print("{}Our Query IDs dataframe has a size of: {} kB".format(spacer, round((asizeof.asizeof(temp_df) / 1024))))
-    # exit()
 
-    # Drop all unwanted columns
-    print("Stage 4: Extracting required fields from API response data")
-    df = temp_df.drop(columns=[col for col in temp_df if col not in baseLabels])
-    print("{}Our results dataframe has a size of: {} kB".format(spacer, round(asizeof.asizeof(df) / 1024)))
-    temp_df.loc[:] = None
+##################################################################
+def main(resume=False, run_timestamp=None):
+    # Run the report, and return the files written and the run metrics, to be served by --serve
+    global end_time
 
-    if debug:
-        print("{}Unified Search dataframe columns: {}".format(spacer, list(df.columns)))
+    if memoryTracing:
+        tracemalloc.start()
 
-    # Get entity data for queries in dataframe
-    print("Stage 5: Begin collecting query entity data")
-    insights_df = pd.DataFrame(get_entitiesV2(base_url, auth_token, df))
-    print("{}The entire entities dataframe has a size of: {} kB".format(
-        spacer, round(asizeof.asizeof(insights_df) / 1024))
-    )
-    print("{}Collection of query entity data completed".format(spacer))
+    # Metrics are per run, so a long-running --serve process starts each run afresh
+    with metricsLock:
+        stageMetrics.clear()
+        requestMetrics.clear()
 
-    if debug:
-        print("{}Insights df columns: {}".format(spacer, list(insights_df.columns)))
-        out_file = dataDir + '/Insights-Source_df-{}.csv'.format(datetime.now().strftime('%Y%m%d_%H%M%S.%f')[:-7])
-        insights_df.to_csv(out_file, index=False)
+    # Disable warnings from urllib3 about unverified HTTPS requests
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    end_time = datetime.now().astimezone().isoformat()
+    run_timestamp = run_timestamp or datetime.now().strftime('%Y%m%d_%H%M%S.%f')[:-7]
+
+    # A resumed run keeps the search window and output file names of the run it resumes
+    checkpoint = load_checkpoint(checkpointFile) if resume else None
+    if checkpoint and ('targets' in checkpoint) == bool(targets):
+        end_time = checkpoint['end_time']
+        run_timestamp = checkpoint['run_timestamp']
+    elif resume:
+        print("No interrupted run to resume, so starting a new run")
+        checkpoint = None
 
     # Generate output file handles
-    print("Stage 6: Generating report output files")
     # Full output
-    out_file = dataDir + '/Impact_Report-{}.csv'.format(datetime.now().strftime('%Y%m%d_%H%M%S.%f')[:-7])
+    out_file = dataDir + '/Impact_Report-{}.csv{}'.format(run_timestamp, compressionSuffixes[reportCompression])
 
-    # Top 10 output
-    top10_out_file = dataDir + '/Impact_Report-Top-10-{}.csv'.format(datetime.now().strftime('%Y%m%d_%H%M%S.%f')[:-7])
-
-    # Write df to csv
-    print("Stage 7: Writing report files to disk")
-    try:
-        # Full output
-        insights_df.to_csv(out_file, index=False)
-        print("{}Report of {} records output to:\n\t\t {}".format(spacer, insights_df.shape[0], out_file))
-    except:
-        print("{}Failure when writing complete data to CSV file: {}".format(spacer, out_file))
+    # Top N outputs, one per ranking
+    top_out_files = {
+        ranking: dataDir + '/Impact_Report-Top-{}-{}{}.csv'.format(
+            topCount, rankingFileLabels[ranking], run_timestamp
+        ) for ranking in topRankings
+    }
 
-    try:
-        insights_df.head(10).to_csv(top10_out_file, index=False)
-        print("{}Report of Top 10 records output to:\n\t\t {}".format(spacer, top10_out_file))
-    except:
-        print("{}Failure when writing Top 10 Report to CSV file: {}".format(spacer, top10_out_file))
+    # Rollup outputs, one per table
+    rollup_out_files = {
+        table: dataDir + '/Impact_Report-Rollup-By-{}-{}.csv'.format(table, run_timestamp) for table in rollupTables
+    }
 
-    print("Stage 8: Report generation completed!")
+    # Multiple targets are merged into combined reports, with a "Target" column to tell them apart
+    # Multiple targets each keep their own checkpoint journal, alongside one for the run as a whole that records
+    # the targets completed so far
+    if targets:
+        if checkpointFile and not checkpoint:
+            write_checkpoint_header(checkpointFile, {'end_time': end_time, 'run_timestamp': run_timestamp,
+                                                     'targets': [target['name'] for target in targets]})
+        summary, top_rows = collect_targets(out_file, run_timestamp, checkpoint)
+        out_columns = ['Target'] + reportColumns
+    else:
+        summary, top_rows = collect_report(out_file, run_timestamp, checkpoint)
+        out_columns = reportColumns
+
+    begin_stage("Stage 6: Generating report output files")
+    print("{}Report of {} records output to:\n\t\t {}".format(spacer, summary['rows'], out_file))
+    if parquetOutput:
+        print("{}Parquet report output to:\n\t\t {}".format(spacer, parquetDir))
+    if stateFile and not targets:
+        print("{}Saved run state for {} queries to:\n\t\t {}".format(spacer, summary['queries'], stateFile))
+
+    # Write Top N reports to csv
+    begin_stage("Stage 7: Writing report files to disk")
+    skipped_out_file = None
+    for ranking, top_out_file in top_out_files.items():
+        try:
+            with open(os.path.expanduser(top_out_file), 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=out_columns, lineterminator='\n')
+                writer.writeheader()
+                writer.writerows(top_rows[ranking])
+            print("{}Report of Top {} records by {} output to:\n\t\t {}".format(
+                spacer, topCount, ranking, top_out_file)
+            )
+        except:
+            print("{}Failure when writing Top {} by {} Report to CSV file: {}".format(
+                spacer, topCount, ranking, top_out_file)
+            )
+
+    # Write the rollup tables to csv
+    for table, rollup_out_file in rollup_out_files.items():
+        try:
+            with open(os.path.expanduser(rollup_out_file), 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=out_columns[:len(out_columns) - len(reportColumns)] +
+                                        [rollupGroupColumns[table]] + rollupColumns, lineterminator='\n')
+                writer.writeheader()
+                writer.writerows(summary['rollups'][table])
+            print("{}Rollup of {} groups by {} output to:\n\t\t {}".format(
+                spacer, len(summary['rollups'][table]), table, rollup_out_file)
+            )
+        except OSError:
+            print("{}Failure when writing Rollup by {} to CSV file: {}".format(spacer, table, rollup_out_file))
+
+    # List the queries that were skipped, and why, so that none are silently missing from the report
+    if summary['skipped']:
+        skipped_out_file = dataDir + '/Impact_Report-Skipped-{}.csv'.format(run_timestamp)
+        try:
+            with open(os.path.expanduser(skipped_out_file), 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=out_columns[:len(out_columns) - len(reportColumns)] +
+                                        ['clusterId', 'id', 'Status', 'Reason'], lineterminator='\n')
+                writer.writeheader()
+                writer.writerows(summary['skipped'])
+            print("{}Report of {} skipped queries output to:\n\t\t {}".format(
+                spacer, len(summary['skipped']), skipped_out_file)
+            )
+        except OSError:
+            print("{}Failure when writing Skipped Report to CSV file: {}".format(spacer, skipped_out_file))
+            skipped_out_file = None
+
+    # The run is complete, so there is nothing left to resume, other than the targets that failed
+    failed_targets = summary.get('failed_targets', [])
+    if failed_targets:
+        print("{}Run again with --resume to carry on with the failed targets: {}".format(
+            spacer, ', '.join(failed_targets))
+        )
+    else:
+        remove_checkpoint(checkpointFile)
+    for target in targets:
+        if target['name'] not in failed_targets:
+            remove_checkpoint(target_file(checkpointFile, target['name']))
+
+    begin_stage("Stage 8: Report generation completed!")
+    print_stage_metrics()
+    metrics = format_run_metrics()
+    if metricsOutput:
+        metrics_file_base = dataDir + '/Impact_Report-Metrics-{}'.format(run_timestamp)
+        try:
+            write_run_metrics(metrics_file_base, metrics)
+            print("{}Run metrics output to:\n\t\t {}.json\n\t\t {}.prom".format(
+                spacer, metrics_file_base, metrics_file_base)
+            )
+        except OSError:
+            print("{}Failure when writing run metrics to: {}".format(spacer, metrics_file_base))
 
     # And that's it!
+    return {'end_time': end_time, 'run_timestamp': run_timestamp, 'out_file': out_file, 'top_out_files': top_out_files,
+            'rollup_out_files': rollup_out_files, 'skipped_out_file': skipped_out_file, 'metrics': metrics}
+##################################################################
+
+
+##################################################################
+def served_path(ranking: str):
+    # URL path of a Top N report, e.g. 'Cost (USD)' => /top-by-cost.csv
+    label = rankingFileLabels[ranking].rstrip('-').lower()
+    return '/top{}.csv'.format('-' + label if label else '')
+##################################################################
+
+
+##################################################################
+def publish_report(run: dict):
+    # Read the files of a completed run into memory, and replace the served report with them in one go
+    content_types = {None: 'text/csv', 'gzip': 'application/gzip', 'zstd': 'application/zstd'}
+    files = {'/report.csv' + compressionSuffixes[reportCompression]: (
+        content_types[reportCompression], run['out_file'])}
+    files.update({served_path(ranking): ('text/csv', top_out_file)
+                  for ranking, top_out_file in run['top_out_files'].items()})
+    files.update({'/rollup-by-{}.csv'.format(table.lower()): ('text/csv', rollup_out_file)
+                  for table, rollup_out_file in run['rollup_out_files'].items()})
+    if run['skipped_out_file']:
+        files['/skipped.csv'] = ('text/csv', run['skipped_out_file'])
+
+    served = {}
+    for path, (content_type, file_name) in files.items():
+        with open(os.path.expanduser(file_name), 'rb') as f:
+            served[path] = (content_type, f.read())
+    metrics_json, metrics_prom = run['metrics']
+    served['/metrics.json'] = ('application/json', metrics_json.encode())
+    served['/metrics'] = ('text/plain; version=0.0.4', metrics_prom.encode())
+
+    global servedReport
+    servedReport = {'files': served, 'end_time': run['end_time'],
+                    'generated': datetime.now().astimezone().isoformat(timespec='seconds')}
+##################################################################
+
+
+##################################################################
+def remove_run_files(run_timestamp: str):
+    # Remove every file a run wrote to dataDir, including those of its targets, and its Parquet files
+    patterns = [
+        os.path.join(glob.escape(os.path.expanduser(dataDir)), 'Impact_Report-*{}*'.format(run_timestamp)),
+        os.path.join(glob.escape(os.path.expanduser(parquetDir)), '**', 'part-Impact_Report-*{}.parquet'.format(
+            run_timestamp))
+    ]
+    for pattern in patterns:
+        for file_name in glob.glob(pattern, recursive=True):
+            try:
+                os.remove(file_name)
+            except OSError:
+                print("{}Failure when removing old report file: {}".format(spacer, file_name))
+##################################################################
+
+
+##################################################################
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    # Serve the files of servedReport from memory, and the status of the --serve loop at /
+    status = {}
+
+    def do_GET(self):
+        report = servedReport
+        path = self.path.split('?', 1)[0]
+        if path == '/':
+            status = dict(self.status, generated=report.get('generated'), end_time=report.get('end_time'),
+                          files=sorted(report.get('files', {})))
+            content_type, body = 'application/json', json.dumps(status, indent=2).encode()
+        elif path in report.get('files', {}):
+            content_type, body = report['files'][path]
+        else:
+            message = 'No report has been generated yet' if not report else 'Not found'
+            self.send_error(503 if not report else 404, message)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if debug:
+            super().log_message(format, *args)
+##################################################################
+
+
+##################################################################
+def serve(resume=False):
+    # Serve the latest report over HTTP, and run the report again every refreshMinutes
+    # A failed run is reported in the status, and the report of the last completed run is served until the next
+    server = ThreadingHTTPServer((serveHost, servePort), ReportRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Serving the latest report at http://{}:{}/, refreshed every {} minutes".format(
+        serveHost, server.server_port, refreshMinutes)
+    )
+
+    status = ReportRequestHandler.status
+    kept_runs = deque()
+    try:
+        while True:
+            run_started = time.time()
+            run_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S.%f')[:-7]
+            status.update({'running': True, 'run_started': datetime.now().astimezone().isoformat(timespec='seconds')})
+            try:
+                run = main(resume=resume, run_timestamp=run_timestamp)
+                publish_report(run)
+                status['last_error'] = None
+                # The files of older runs are no longer served, so only the last serveKeepRuns are kept
+                kept_runs.append(run['run_timestamp'])
+                while len(kept_runs) > max(1, serveKeepRuns):
+                    remove_run_files(kept_runs.popleft())
+            except (SystemExit, Exception) as error:
+                # SystemExit is how the stages report a failure, e.g. no response from Unravel
+                status['last_error'] = '{}: {}'.format(type(error).__name__, error)
+                print("{}Run failed, so still serving the report of the last completed run: {}".format(
+                    spacer, status['last_error'])
+                )
+                if run_timestamp not in kept_runs:
+                    remove_run_files(run_timestamp)
+            resume = False
+
+            next_run = run_started + refreshMinutes * 60
+            status.update({'running': False,
+                           'next_run': datetime.fromtimestamp(next_run).astimezone().isoformat(timespec='seconds')})
+            time.sleep(max(0.0, next_run - time.time()))
+    except KeyboardInterrupt:
+        print("Stopped serving")
+    finally:
+        server.shutdown()
+        server.server_close()
 ##################################################################
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Unravel High Impact query report')
+    parser.add_argument('--resume', action='store_true',
+                        help='Carry on from where an interrupted run stopped, using its checkpoint journal')
+    parser.add_argument('--serve', action='store_true',
+                        help='Keep running, refresh the report every refreshMinutes, and serve the latest over HTTP')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(resume=args.resume)
+        exit(0)
+
+    # Record the start time of the script
+    run_start_time = datetime.now()
+    print("Start  :", str(datetime.now().time())[:-7])
 
+    main(resume=args.resume)
 
-print("\nFinish :", str(datetime.now().time())[:-7])
-print("Total execution time: {}".format(datetime.now() - run_start_time))
+    print("\nFinish :", str(datetime.now().time())[:-7])
+    print("Total execution time: {}".format(datetime.now() - run_start_time))
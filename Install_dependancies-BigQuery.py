@@ -1,7 +1,7 @@
 import datetime, pip, platform, sys
 start_time = datetime.datetime.now()
 
-packageList = ['os', 'progress', 'requests', 'urllib3', 'json', 'sys', 'datetime', 'pympler', 'pandas']
+packageList = ['os', 'progress', 'requests', 'urllib3', 'json', 'sys', 'datetime', 'pandas']
 pkgs = "\t" + '\n\t'.join(packageList)
 python_context = "Using Python version: {}, found at: \"{}\"".format(platform.python_version(), sys.executable)
 pip_context = "Using Pip version: {}".format(pip.__version__)
@@ -0,0 +1,94 @@
+# Import necessary modules
+import os, subprocess, sys, time
+from datetime import datetime
+##################################################################
+run_start_time = datetime.now()
+print("Start  :", str(datetime.now().time())[:-7])
+##################################################################
+
+# scriptFile   => The report script to measure the cold start of
+# trials       => Number of cold starts to measure. The median is reported
+# maxStartup   => Fail (exit 1) if the median cold start, less bare interpreter start, exceeds this many seconds
+# slowImports  => Number of slowest imports to list, as measured by 'python -X importtime'
+scriptFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'High_Impact_Full_and_Top10.v4.2.py')
+trials = 10
+maxStartup = 0.5
+slowImports = 10
+
+spacer = '         '
+
+# Import the script as a module without running main(), the same as the interpreter does before Stage 1
+importSnippet = (
+    "import importlib.util as u; "
+    "s = u.spec_from_file_location('impact_report', {!r}); "
+    "s.loader.exec_module(u.module_from_spec(s))"
+).format(scriptFile)
+
+
+##################################################################
+# Start Functions Block
+##################################################################
+def time_cold_start(snippet: str):
+    # Wall time of a fresh interpreter running snippet, in seconds
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', snippet], check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started
+##################################################################
+
+
+##################################################################
+def median(values: list):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+##################################################################
+
+
+##################################################################
+def slowest_imports(snippet: str, count: int):
+    # Parse 'python -X importtime' output into (cumulative seconds, module), slowest first
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', snippet],
+                            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        # Only top-level imports, as the nested ones are already counted in their parent's cumulative time
+        if module.startswith('  '):
+            continue
+        imports.append((int(cumulative_us) / 1000000, module.strip()))
+
+    return sorted(imports, reverse=True)[:count]
+##################################################################
+
+
+##################################################################
+def main():
+    print("Stage 1: Measuring bare interpreter start over {} trials".format(trials))
+    interpreter = median([time_cold_start('pass') for _ in range(trials)])
+    print("{}Median: {:.3f}s".format(spacer, interpreter))
+
+    print("Stage 2: Measuring report script cold start over {} trials".format(trials))
+    cold_start = median([time_cold_start(importSnippet) for _ in range(trials)])
+    startup = cold_start - interpreter
+    print("{}Median: {:.3f}s, of which {:.3f}s is the script and its imports".format(spacer, cold_start, startup))
+
+    print("Stage 3: Slowest top-level imports")
+    for seconds, module in slowest_imports(importSnippet, slowImports):
+        print("{}{:>8.3f}s  {}".format(spacer, seconds, module))
+
+    if startup > maxStartup:
+        print("{}FAILED: script start of {:.3f}s exceeds the limit of {:.3f}s".format(spacer, startup, maxStartup))
+        exit(1)
+    print("{}PASSED: script start of {:.3f}s is within the limit of {:.3f}s".format(spacer, startup, maxStartup))
+
+##################################################################
+# End Functions Block
+##################################################################
+
+if __name__ == "__main__":
+    main()
+
+    print("\nFinish :", str(datetime.now().time())[:-7])
+    print("Total execution time: {}".format(datetime.now() - run_start_time))
@@ -0,0 +1,342 @@
+##################################################################
+# Local stand-in for the parts of the Unravel REST API used by the
+# Impact Report and tester scripts, for offline, reproducible load tests.
+# Payloads are synthetic but shaped like Data/_Sample_Bigquery_Entities_Response.json,
+# and the same seed always produces the same queries and analysis.
+#
+# Endpoints:
+# POST /api/v1/signIn                                   ==> JWT for any credentials
+# POST /api/v1/apps/unifiedsearch                       ==> Paged query list, filtered on start_time/end_time
+# GET  /api/v1/apps/events/inefficient_apps_newux/      ==> Paged list of flagged queries
+# GET  /api/v1/bigquery/{clusterId}/{id}/analysis       ==> Per-query insightsV2 analysis
+#
+# Point the report at it with:
+# urlsDict = {'bigquery': 'http://127.0.0.1:4043'}
+##################################################################
+
+# Import necessary modules
+import argparse, base64, gzip, hashlib, json, math, random, threading, time
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Define the default configuration of the mock server
+# Every item can also be set on the command line, e.g. --records 100000 --latency 40
+##################################################################
+
+# port          => Port to listen on, on 127.0.0.1
+# records       => Number of synthetic queries
+# clusters      => Number of synthetic clusterIds (BigQuery projects) the queries are spread over
+# spanDays      => Queries are spread evenly over this many days back from server start
+# seed          => Seed for all synthetic data
+# latency       => Mean added response latency, in milliseconds
+# jitter        => Response latency varies uniformly by up to this many milliseconds either side of the mean
+# errorRate     => Fraction of requests (other than signIn) answered with a 503
+# maxPageSize   => Larger unifiedsearch/inefficient_apps pages get a non-dict body, as the real server does
+# tokenTTL      => Lifetime of issued tokens, in seconds. Requests with an expired token get a 401
+port = 4043
+records = 20000
+clusters = 8
+spanDays = 365
+seed = 42
+latency = 0
+jitter = 0
+errorRate = 0.0
+maxPageSize = 10000
+tokenTTL = 3600
+
+# End of config items
+##################################################################
+statusCodes = ['S', 'S', 'S', 'S', 'S', 'S', 'F', 'K', 'R', 'P']
+insightCatalogue = {
+    'Bottlenecks': ['Slow SQL Stage', 'Data Skew', 'Large Shuffle', 'Slot Contention'],
+    'Efficiency': ['Partition Pruning', 'Unused Columns', 'Cross Join', 'Repeated Query'],
+    'Recommendations': ['Missing Filter', 'Clustering Candidate', 'Materialized View Candidate']
+}
+
+
+##################################################################
+# Start Functions Block
+##################################################################
+class MockData:
+    # Deterministic synthetic queries and analysis. Query 0 is the most recent
+    def __init__(self, settings):
+        self.settings = settings
+        self.anchor = datetime.now().astimezone()
+        self.step = timedelta(days=settings.spanDays) / max(1, settings.records)
+        self.flagged = None
+        self.ids = None
+        self.attempts = {}
+        self.lock = threading.Lock()
+
+    def cluster_id(self, i: int):
+        return 'unravel-bigquery-project-{:03d}'.format(i % self.settings.clusters)
+
+    def query(self, i: int):
+        rng = random.Random('{}-query-{}'.format(self.settings.seed, i))
+        cluster_id = self.cluster_id(i)
+        return {
+            'id': '{}-US-{}'.format(cluster_id, hashlib.md5('{}-{}'.format(self.settings.seed, i).encode()).hexdigest()),
+            'clusterId': cluster_id,
+            'cents': round(rng.lognormvariate(3, 1.5), 2),
+            'status': rng.choice(statusCodes),
+            'startTime': (self.anchor - self.step * i).isoformat(),
+            # Fields of the full app record that the report doesn't use
+            'kind': 'BIGQUERY',
+            'user': 'user{}@example.com'.format(rng.randint(1, 200)),
+            'queue': 'reservation-{}'.format(rng.randint(1, 5)),
+            'duration': rng.randint(100, 3600000),
+            'totalSlotMs': rng.randint(1000, 10 ** 9),
+            'bytesProcessed': rng.randint(10 ** 6, 10 ** 13),
+            'queryText': 'SELECT * FROM dataset_{}.table_{} WHERE ...'.format(rng.randint(1, 50), rng.randint(1, 500)),
+            'labels': {'team': 'team-{}'.format(rng.randint(1, 20)), 'env': rng.choice(['dev', 'prod'])}
+        }
+
+    def analysis(self, i: int):
+        rng = random.Random('{}-analysis-{}'.format(self.settings.seed, i))
+        query = self.query(i)
+        insights = []
+        for key in rng.sample(sorted(insightCatalogue), rng.randint(0, 2)):
+            categories = {}
+            for title in rng.sample(insightCatalogue[key], rng.randint(1, 3)):
+                instances = [{
+                    'key': key,
+                    'subcategory': 'Query {}'.format(query['id']),
+                    'title': title,
+                    'events': 'Synthetic event {}'.format(n),
+                    'actions': '',
+                    'type': key[:3].upper(),
+                    'impact': rng.randint(5, 95)
+                } for n in range(rng.randint(1, 5))]
+                categories[title] = {
+                    'instances': instances,
+                    'impact': max(instance['impact'] for instance in instances),
+                    'numQueries': 1
+                }
+            insights.append({'key': key, 'categories': categories})
+
+        return {'id': query['id'], 'kind': 'BIGQUERY', 'insightsV2': insights}
+
+    def index_of(self, query_id: str):
+        # Query ids end in the hash of the query index, so keep a reverse lookup
+        with self.lock:
+            if self.ids is None:
+                self.ids = {self.query(i)['id']: i for i in range(self.settings.records)}
+        return self.ids.get(query_id)
+
+    def window(self, start_time, end_time):
+        # Range of query indexes whose startTime lies within [start_time, end_time]
+        first, last = 0, self.settings.records
+        if end_time:
+            first = max(first, math.ceil((self.anchor - parse_time(end_time)) / self.step))
+        if start_time:
+            last = min(last, math.floor((self.anchor - parse_time(start_time)) / self.step) + 1)
+        return range(first, max(first, last))
+
+    def request_rng(self, request_key: str):
+        # Seeded per request and per attempt at it, so that latency and injected errors are the same on every run,
+        # whatever order concurrent requests arrive in
+        with self.lock:
+            attempt = self.attempts.get(request_key, 0)
+            self.attempts[request_key] = attempt + 1
+        return random.Random('{}-request-{}-{}'.format(self.settings.seed, request_key, attempt))
+
+    def flagged_queries(self):
+        # Queries with at least one High impact insight are "inefficient"
+        with self.lock:
+            if self.flagged is None:
+                self.flagged = [
+                    i for i in range(self.settings.records)
+                    if any(category['impact'] > 70
+                           for ent in self.analysis(i)['insightsV2'] for category in ent['categories'].values())
+                ]
+        return self.flagged
+##################################################################
+
+
+##################################################################
+def parse_time(value: str):
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.astimezone()
+    return parsed
+##################################################################
+
+
+##################################################################
+def make_token(ttl: int):
+    # Unsigned JWT, so that clients can read the 'exp' claim
+    encode = lambda part: base64.urlsafe_b64encode(json.dumps(part).encode()).rstrip(b'=').decode()
+    return '{}.{}.{}'.format(
+        encode({'alg': 'none', 'typ': 'JWT'}),
+        encode({'sub': 'mock', 'iat': int(time.time()), 'exp': int(time.time()) + ttl}),
+        'mock-signature'
+    )
+##################################################################
+
+
+##################################################################
+def token_expiry(authorization: str):
+    try:
+        payload = authorization.split(' ', 1)[1].split('.')[1]
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp']
+    except (IndexError, KeyError, ValueError):
+        return None
+##################################################################
+
+
+##################################################################
+class MockHandler(BaseHTTPRequestHandler):
+    data = None
+    settings = None
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, so Nagle's algorithm would stall every keep-alive response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status: int = 200):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            payload = gzip.compress(payload, compresslevel=5)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def simulate_server(self, body: bytes = b''):
+        # Add latency, then fail a share of requests. Returns False if the request was already answered
+        rng = self.data.request_rng('{} {} {}'.format(self.command, self.path, body.decode(errors='replace')))
+        delay = self.settings.latency + rng.uniform(-self.settings.jitter, self.settings.jitter)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if rng.random() < self.settings.errorRate:
+            self.send_json({'message': 'Service temporarily unavailable'}, 503)
+            return False
+        return True
+
+    def authorised(self):
+        expiry = token_expiry(self.headers.get('Authorization', ''))
+        if expiry is None or expiry < time.time():
+            self.send_json({'message': 'Invalid or expired token'}, 401)
+            return False
+        return True
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        path = urlparse(self.path).path.rstrip('/')
+        body = self.read_body()
+
+        if path == '/api/v1/signIn':
+            credentials = parse_qs(body.decode())
+            if not credentials.get('username') or not credentials.get('password'):
+                return self.send_json({'message': 'Missing username or password'}, 401)
+            return self.send_json({'token': make_token(self.settings.tokenTTL)})
+
+        if path == '/api/v1/apps/unifiedsearch':
+            if not self.authorised() or not self.simulate_server(body):
+                return
+            params = json.loads(body or b'{}')
+            return self.send_page(self.data.window(params.get('start_time'), params.get('end_time')),
+                                  int(params.get('from', 0)), int(params.get('size', 10)),
+                                  self.data.query, 'totalRecords')
+
+        self.send_json({'message': 'Not found'}, 404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+
+        if url.path.rstrip('/') == '/api/v1/apps/events/inefficient_apps_newux':
+            if not self.authorised() or not self.simulate_server():
+                return
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            window = self.data.window(params.get('start_time'), params.get('end_time'))
+            flagged = [i for i in self.data.flagged_queries() if i in window]
+            return self.send_page(flagged, int(params.get('from', 0)), int(params.get('size', 10)),
+                                  self.data.query, 'total')
+
+        if len(parts) == 6 and parts[:3] == ['api', 'v1', 'bigquery'] and parts[5] == 'analysis':
+            if not self.authorised() or not self.simulate_server():
+                return
+            i = self.data.index_of(parts[4])
+            if i is None or not self.data.query(i)['clusterId'] == parts[3]:
+                return self.send_json({'message': 'Unknown query'}, 404)
+            return self.send_json(self.data.analysis(i))
+
+        self.send_json({'message': 'Not found'}, 404)
+
+    def send_page(self, indexes, page_from: int, size: int, build, total_key: str):
+        if size > self.settings.maxPageSize:
+            # The real server answers oversized requests with a body that isn't a dict
+            return self.send_json(['Result window is too large'])
+
+        cluster_counts = {}
+        for i in indexes:
+            cluster_id = self.data.cluster_id(i)
+            cluster_counts[cluster_id] = cluster_counts.get(cluster_id, 0) + 1
+        self.send_json({
+            'metadata': {total_key: len(indexes), 'clusters': cluster_counts},
+            total_key: len(indexes),
+            'results': [build(i) for i in indexes[page_from:page_from + size]],
+            'aggregations': {}
+        })
+##################################################################
+
+
+##################################################################
+def start_mock_server(settings):
+    # Start the mock server in a background thread, returning the server. Its URL is server.url
+    # Each server gets a handler class of its own, so several servers with different settings can run at once
+    handler = type('MockHandler', (MockHandler,), {'settings': settings, 'data': MockData(settings)})
+    ThreadingHTTPServer.request_queue_size = 256
+    ThreadingHTTPServer.daemon_threads = True
+    server = ThreadingHTTPServer(('127.0.0.1', settings.port), handler)
+    server.url = 'http://127.0.0.1:{}'.format(server.server_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+##################################################################
+
+
+##################################################################
+def parse_settings(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for the Unravel REST API')
+    parser.add_argument('--port', type=int, default=port)
+    parser.add_argument('--records', type=int, default=records)
+    parser.add_argument('--clusters', type=int, default=clusters)
+    parser.add_argument('--spanDays', type=float, default=spanDays)
+    parser.add_argument('--seed', type=int, default=seed)
+    parser.add_argument('--latency', type=float, default=latency)
+    parser.add_argument('--jitter', type=float, default=jitter)
+    parser.add_argument('--errorRate', type=float, default=errorRate)
+    parser.add_argument('--maxPageSize', type=int, default=maxPageSize)
+    parser.add_argument('--tokenTTL', type=int, default=tokenTTL)
+    return parser.parse_args(argv)
+##################################################################
+
+
+##################################################################
+def main():
+    settings = parse_settings()
+    server = start_mock_server(settings)
+    print("Mock Unravel API serving {} queries over {} days at: {}".format(
+        settings.records, settings.spanDays, server.url)
+    )
+    print("Latency: {}ms +/- {}ms, error rate: {}".format(settings.latency, settings.jitter, settings.errorRate))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+##################################################################
+# End Functions Block
+##################################################################
+
+if __name__ == "__main__":
+    main()
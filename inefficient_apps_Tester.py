@@ -1,7 +1,6 @@
 # Import necessary modules
 import os, requests, urllib3, json, sys
 from datetime import timedelta, datetime
-from pympler import asizeof
 import pandas as pd
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 ##################################################################
@@ -37,8 +36,29 @@ appStatus = list(statusMapDict.keys())
 
 end_time = datetime.now().astimezone().isoformat()
 
+# connectTimeout => Seconds to wait for a connection to the Unravel server
+# readTimeout    => Seconds to wait for the Unravel server to send each response
+connectTimeout = 10
+readTimeout = 300
+
+# One pooled HTTP session shared by every request, created in main()
+httpSession = None
+
 ##################################################################
 # Start Functions Block
+##################################################################
+def create_http_session(pool_size: int):
+    # Keep-alive connection pool sized so that no worker waits for a connection,
+    # asking the server for compressed response bodies
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    return session
+##################################################################
+
+
 ##################################################################
 def print_api_debug_info(f_status, f_data, f_message: str, f_result: str):
     f_message = "{}{} Failed to acquire {}.  Status code: {}".format(
@@ -83,10 +103,11 @@ def get_auth_token(platform):
     endpoint_url = '{}/api/v1/signIn'.format(urlsDict[platform])
 
     # POST to the auth endpoint with the auth data
-    response = requests.post(
+    response = httpSession.post(
         endpoint_url,
         data=authDict,
-        verify=True
+        verify=True,
+        timeout=(connectTimeout, readTimeout)
     )
 
     # Check the response status code
@@ -122,10 +143,11 @@ def record_count(url, auth_token):
                    }
 
     # Request the number of available records
-    response = requests.post(
+    response = httpSession.post(
         search_url,
         data=json.dumps(params_dict),
         verify=False,
+        timeout=(connectTimeout, readTimeout),
         headers={'Authorization': auth_token,
                  'Accept': 'application/json',
                  'Content-Type': 'application/json'})
@@ -189,10 +211,11 @@ def unified_search(url, auth_token, count: int):
     print("{}Retrieving data for {} queries:".format(spacer, params_dict['size']))
 
     # Query UnifiedSearch API to get reference data on all queries
-    response = requests.post(
+    response = httpSession.post(
         search_url,
         data=json.dumps(params_dict),
         verify=False,
+        timeout=(connectTimeout, readTimeout),
         headers={'Authorization': auth_token,
                  'Accept': 'application/json',
                  'Content-Type': 'application/json'})
@@ -221,9 +244,10 @@ def inefficient_apps(url, auth_token, count: int):
 
     apps_url = url + '/api/v1/apps/events/inefficient_apps_newux/'
     # apps_url = url + '/api/v1/apps/events/inefficient_apps'
-    search_response = requests.get(
+    search_response = httpSession.get(
         apps_url,
         verify=False,
+        timeout=(connectTimeout, readTimeout),
         params=params_dict,
         headers=headers_dict).json()
     print("\tOld method returned a data type of: {}".format(type(search_response)))
@@ -243,6 +267,11 @@ def inefficient_apps(url, auth_token, count: int):
 
 ##################################################################
 def main():
+    global httpSession
+
+    # Share one pooled, compressed HTTP session between every request
+    httpSession = create_http_session(1)
+
     # Get auth_token
     print("Stage 1: Generating authentication token")
     auth_token = get_auth_token(platform)